@@ -0,0 +1,134 @@
+"""
+Maintenance commands for the MonkeyBadge redis database, run from this
+directory with the same MB_REDIS_HOST / MB_REDIS_PORT as the api server.
+
+    python admin.py migrate
+    python admin.py rebuild-leaderboard
+    python admin.py export badges.ndjson
+    python admin.py import badges.ndjson
+
+migrate runs the api server's startup migrations, such as moving an older
+database to the namespaced badge keys, without starting the server.
+
+export writes a {"game_phase": {...}} line with the game phase flags, then
+one {"uuid": ..., "badge": {...}} line per badge document, to stdout with
+"-".  import writes them back along with the IR_ID, token and friend
+indexes, then rebuilds the leaderboard and restores the game phase.  Both stream the badges in
+chunks, so memory use doesn't grow with the number of badges.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import sys
+
+import orjson
+
+import main
+
+# badges fetched or written per round trip
+chunk_size = 1000
+
+
+async def migrate(args):
+    await main.run_migrations(main.connect_redis())
+    print("migrations done")
+
+
+async def rebuild_leaderboard(args):
+    count = await main.rebuild_leaderboard(main.connect_redis())
+    print(f"leaderboard rebuilt with {count} badges")
+
+
+def open_file(path, mode):
+    """opens path, or stdin / stdout for "-" """
+    if path == "-":
+        return contextlib.nullcontext(
+            sys.stdout.buffer if "w" in mode else sys.stdin.buffer
+        )
+    return open(path, mode)
+
+
+async def read_lines(f):
+    for line in f:
+        if line.strip():
+            yield orjson.loads(line)
+
+
+async def export_badges(args):
+    client = main.connect_redis()
+    count = 0
+    with open_file(args.file, "wb") as f:
+        phase = await client.hgetall(main.GAME_PHASE)
+        phase = {k.decode(): int(v) for k, v in phase.items()}
+        f.write(orjson.dumps({"game_phase": phase}))
+        f.write(b"\n")
+        async for chunk in main.badge_id_chunks(client, chunk_size):
+            keys = [main.badge_key(badge_id) for badge_id in chunk]
+            badges = await client.json.mget(keys, ".")
+            for badge_id, badge in zip(chunk, badges):
+                # deleted since the scan saw it
+                if badge is None:
+                    continue
+                f.write(orjson.dumps({"uuid": badge_id, "badge": badge}))
+                f.write(b"\n")
+                count += 1
+    print(f"exported {count} badges", file=sys.stderr)
+
+
+async def import_badges(args):
+    client = main.connect_redis()
+    count = 0
+    phase = None
+    with open_file(args.file, "rb") as f:
+        async for chunk in main.chunked(read_lines(f), chunk_size):
+            async with await client.pipeline(transaction=False) as pipe:
+                for record in chunk:
+                    if "game_phase" in record:
+                        phase = record["game_phase"]
+                        continue
+                    uuid, badge = record["uuid"], record["badge"]
+                    await pipe.json.set(main.badge_key(uuid), ".", badge)
+                    await pipe.sadd(main.BADGES, [uuid])
+                    if badge.get("IR_ID") not in (None, ""):
+                        await pipe.set(main.irid_key(badge["IR_ID"]), uuid)
+                        await pipe.srem(main.IRID_POOL, [badge["IR_ID"]])
+                    if badge.get("token"):
+                        await pipe.set(main.token_key(badge["token"]), uuid)
+                    await pipe.delete([main.friends_key(uuid)])
+                    friends = main.match_uuids(
+                        badge.get("challenge1", {}).get("matches")
+                    )
+                    if friends:
+                        await pipe.sadd(main.friends_key(uuid), friends)
+                    count += 1
+                await pipe.execute()
+    print(f"imported {count} badges", file=sys.stderr)
+    count = await main.rebuild_leaderboard(client)
+    print(f"leaderboard rebuilt with {count} badges", file=sys.stderr)
+    # exports from before the game phase was included don't have it
+    if phase:
+        await main.set_game_phase(client, **phase)
+        print(f"game phase restored: {phase}", file=sys.stderr)
+
+
+commands = {
+    "migrate": migrate,
+    "rebuild-leaderboard": rebuild_leaderboard,
+    "export": export_badges,
+    "import": import_badges,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Maintenance commands for the MonkeyBadge redis database"
+    )
+    parser.add_argument("command", choices=commands)
+    parser.add_argument(
+        "file", nargs="?", default="-", help="NDJSON file for export and import"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=main.loglevel)
+    asyncio.run(commands[args.command](args))
@@ -0,0 +1,90 @@
+"""
+Microbenchmark of the per-request cost of building and serializing the
+api server's responses, comparing the plain dict + jsonable_encoder + json
+path FastAPI used before with the OrjsonResponse endpoints return now.
+
+    python bench_serialization.py [iterations]
+"""
+
+import json
+import sys
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import main
+
+
+def late_game_badge(matches=20):
+    j = main.new_badge()
+    j["badgeHandle"] = "bench-monkey"
+    j["IR_ID"] = 4242
+    j["token"] = "x" * 22
+    j["current_challenge"] = "challenge2"
+    j["intro"] = {"enabled": 1, "complete": 1}
+    j["challenge1"]["complete"] = 1
+    for i in range(matches):
+        j["challenge1"]["matches"][str(i + 100)] = {
+            "handle": f"friend-{i}",
+            "uuid": f"00-00-00-00-00-{i:02x}",
+        }
+    j["challenge2"]["status"] = [1, 1, 0, 1, 0]
+    return j
+
+
+def fastapi_dict(content):
+    """what FastAPI did with a dict returned from an endpoint"""
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def orjson_response(content):
+    return main.OrjsonResponse(content).body
+
+
+def bench(iterations):
+    badge = late_game_badge()
+    encoded = json.dumps(badge).encode()
+    template = json.dumps(main.badge_template)
+    batch = {
+        "results": [{"op": "friendrequest", "status": 200, "detail": None}] * 8,
+        "state": badge,
+    }
+    leaderboard = {
+        "total": 2000,
+        "entries": [
+            {"rank": i + 1, "handle": f"monkey-{i}", "score": 6000 - i}
+            for i in range(20)
+        ],
+    }
+
+    cases = [
+        # name, before, after
+        ("register template", lambda: json.loads(template), main.new_badge),
+        (
+            "checkin/hiddenobject/monkeysee",
+            lambda: fastapi_dict(badge),
+            lambda: orjson_response(badge),
+        ),
+        (
+            "friendrequest",
+            lambda: fastapi_dict(json.loads(encoded)),
+            lambda: main.Response(encoded, media_type="application/json").body,
+        ),
+        ("batch", lambda: fastapi_dict(batch), lambda: orjson_response(batch)),
+        (
+            "leaderboard",
+            lambda: fastapi_dict(leaderboard),
+            lambda: orjson_response(leaderboard),
+        ),
+    ]
+
+    print(f"{'':32} {'before':>10} {'after':>10}")
+    for name, before, after in cases:
+        b = timeit.timeit(before, number=iterations) / iterations * 1e6
+        a = timeit.timeit(after, number=iterations) / iterations * 1e6
+        print(f"{name:32} {b:8.1f}us {a:8.1f}us {b / a:6.1f}x")
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,355 @@
+"""
+Simulates a fleet of badges against a running api server and reports
+throughput, per endpoint latency and the redis commands it caused.
+
+Each simulated badge registers, completes the intro, checks in every
+--checkin-period seconds (with jitter), and runs into the other badges that
+are its neighbours in a random "IR graph", the hidden objects and the
+monkeys.  Those encounters are queued and sent to /batch like the firmware
+does, or to the single endpoints with --no-batch.
+
+    python loadtest.py --badges 2000 --duration 300
+
+Badge pickup, when every badge registers at once:
+
+    python loadtest.py --badges 1000 --ramp 0 --register-only
+
+The redis command counts come from INFO commandstats on --redis-host, so
+point it at the same redis as the server and don't share it with anything
+else while the test runs.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from collections import defaultdict
+
+import coredis
+import httpx
+
+import main
+
+
+class Stats:
+    """Latency and status counts for each endpoint"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, status, latency):
+        self.latencies[endpoint].append(latency)
+        self.statuses[endpoint][status] += 1
+
+    def report(self, elapsed):
+        total = sum(len(v) for v in self.latencies.values())
+        print(f"\n{total} requests in {elapsed:.1f}s, {total / elapsed:.1f} req/s\n")
+        print(
+            f"{'endpoint':16} {'count':>8} {'req/s':>8} {'p50 ms':>8} "
+            f"{'p95 ms':>8} {'p99 ms':>8}  statuses"
+        )
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            statuses = ", ".join(
+                f"{k}: {v}" for k, v in sorted(self.statuses[endpoint].items(), key=str)
+            )
+            print(
+                f"{endpoint:16} {len(latencies):8} {len(latencies) / elapsed:8.1f} "
+                f"{percentile(latencies, 50):8.1f} {percentile(latencies, 95):8.1f} "
+                f"{percentile(latencies, 99):8.1f}  {statuses}"
+            )
+        return total
+
+
+def percentile(values, p):
+    """p-th percentile of already sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def random_mac():
+    return "-".join(f"{random.randrange(256):02X}" for _ in range(6))
+
+
+class SimulatedBadge:
+    def __init__(self, http, stats, args):
+        self.http = http
+        self.stats = stats
+        self.args = args
+        self.uuid = random_mac()
+        self.token = None
+        self.irid = None
+        self.state = None
+        self.state_version = None
+        self.neighbours = []
+        self.queue = {}
+        # the unanswered batch and its Idempotency-Key, like the firmware
+        self.batch_names = None
+        self.batch_key = None
+
+    async def request(self, method, endpoint, body=None, headers=None):
+        if self.token:
+            headers = (headers or {}) | {"X-API-Key": self.token}
+        start = time.perf_counter()
+        try:
+            r = await self.http.request(method, endpoint, json=body, headers=headers)
+            status = r.status_code
+        except httpx.HTTPError as err:
+            r = None
+            status = type(err).__name__
+        self.stats.record(endpoint, status, (time.perf_counter() - start) * 1000)
+        return r
+
+    async def post(self, endpoint, body, headers=None):
+        return await self.request("POST", endpoint, body, headers)
+
+    async def register(self):
+        body = {"myUUID": self.uuid, "key": main.registration_key}
+        if self.args.generate_handle:
+            r = await self.request("GET", "/generate_handle")
+            # a failed handle is already counted, carry on without it
+            if r is not None and r.status_code == 200:
+                body["handle"] = r.json()
+        r = await self.post("/register", body)
+        if r is None or r.status_code != 200:
+            return False
+        self.state = r.json()
+        self.token = self.state["token"]
+        self.irid = self.state["IR_ID"]
+        return True
+
+    def load_state(self, state):
+        self.state = state
+        self.state_version = state.get("state_version")
+
+    async def checkin(self):
+        headers = None
+        if self.state_version is not None:
+            headers = {"If-None-Match": f'"{self.state_version}"'}
+        r = await self.post("/checkin", {"myUUID": self.uuid}, headers)
+        if r is not None and r.status_code == 200:
+            self.load_state(r.json())
+
+    def encounter(self, badges):
+        """Something came into IR range, queue the call the firmware would"""
+        roll = random.random()
+        if roll < self.args.object_share:
+            objectid = random.choice(main.hiddenobjects)
+            self.queue[f"hiddenobject_{objectid}"] = {
+                "op": "hiddenobject",
+                "objectid": objectid,
+            }
+        elif roll < self.args.object_share * 2:
+            monkeyid = random.choice(list(main.monkeys.values()))
+            self.queue[f"monkeysee_{monkeyid}"] = {
+                "op": "monkeysee",
+                "objectid": monkeyid,
+            }
+        elif self.neighbours:
+            friend = badges[random.choice(self.neighbours)]
+            if friend.irid is not None:
+                self.queue[f"friendrequest_{friend.irid}"] = {
+                    "op": "friendrequest",
+                    "remoteIRID": str(friend.irid),
+                }
+
+    def sendable(self):
+        """The queued calls the firmware would send in its current challenge"""
+        challenge = self.state["current_challenge"]
+        for name, op in self.queue.items():
+            if op["op"] == "hiddenobject" and challenge != "challenge2":
+                continue
+            if op["op"] == "monkeysee" and challenge != "challenge3":
+                continue
+            yield name, op
+
+    async def flush(self):
+        if self.args.no_batch:
+            await self.flush_single()
+            return
+
+        names = []
+        ops = []
+        for name, op in self.sendable():
+            if op["op"] != "friendrequest" and op["op"] in [o["op"] for o in ops]:
+                continue
+            names.append(name)
+            ops.append(op)
+        if not ops:
+            return
+
+        if names != self.batch_names:
+            self.batch_names = names
+            self.batch_key = f"{random.getrandbits(64):016x}"
+        r = await self.post(
+            "/batch",
+            {"myUUID": self.uuid, "ops": ops},
+            {"Idempotency-Key": self.batch_key},
+        )
+        if r is None or r.status_code != 200:
+            return
+        self.batch_names = None
+        j = r.json()
+        for name, result in zip(names, j["results"]):
+            if result["status"] in (200, 208, 400, 404):
+                del self.queue[name]
+        self.load_state(j["state"])
+
+    async def flush_single(self):
+        for name, op in list(self.sendable()):
+            body = {"myUUID": self.uuid}
+            if op["op"] == "friendrequest":
+                body["remoteIRID"] = op["remoteIRID"]
+            else:
+                body["objectid"] = op["objectid"]
+            r = await self.post(f"/{op['op']}", body)
+            if r is None:
+                continue
+            if r.status_code in (200, 208, 400, 404):
+                del self.queue[name]
+            if r.status_code == 200:
+                self.load_state(r.json())
+
+    async def run(self, badges, start_at, end_at):
+        await asyncio.sleep(max(0, start_at - time.monotonic()))
+        if not await self.register() or self.args.register_only:
+            return
+
+        r = await self.post("/introcomplete", {"myUUID": self.uuid})
+        if r is not None and r.status_code == 200:
+            self.load_state(r.json())
+
+        now = time.monotonic()
+        next_checkin = now + random.uniform(0, self.args.checkin_period)
+        next_encounter = now + random.expovariate(self.args.encounter_rate / 60)
+        next_flush = now + self.args.batch_period
+        while True:
+            wake = min(next_checkin, next_encounter, next_flush)
+            if wake >= end_at:
+                return
+            await asyncio.sleep(max(0, wake - time.monotonic()))
+            now = time.monotonic()
+
+            if now >= next_encounter:
+                self.encounter(badges)
+                next_encounter = now + random.expovariate(self.args.encounter_rate / 60)
+            if now >= next_flush:
+                if self.queue:
+                    await self.flush()
+                next_flush = now + self.args.batch_period
+            if now >= next_checkin:
+                await self.checkin()
+                jitter = self.args.checkin_jitter
+                next_checkin = now + self.args.checkin_period * random.uniform(
+                    1 - jitter, 1 + jitter
+                )
+
+
+def build_ir_graph(badges, degree):
+    """Gives every badge `degree` random neighbours, both ways"""
+    for i, badge in enumerate(badges):
+        for j in random.sample(range(len(badges)), min(degree, len(badges) - 1)):
+            if j != i:
+                badge.neighbours.append(j)
+                badges[j].neighbours.append(i)
+
+
+async def commandstats(redis):
+    """calls per redis command, None if the server won't report them"""
+    try:
+        info = await redis.info("commandstats")
+    except coredis.exceptions.RedisError:
+        return None
+    return {
+        name.removeprefix("cmdstat_"): stats["calls"]
+        for name, stats in info.items()
+        if name.startswith("cmdstat_")
+    }
+
+
+def report_commands(before, after, requests):
+    if before is None or after is None:
+        print("\nredis command counts unavailable (INFO commandstats failed)")
+        return
+
+    calls = {k: v - before.get(k, 0) for k, v in after.items()}
+    calls = {k: v for k, v in calls.items() if v > 0}
+    total = sum(calls.values())
+    print(f"\n{total} redis commands, {total / max(requests, 1):.2f} per request\n")
+    for name, count in sorted(calls.items(), key=lambda kv: -kv[1]):
+        print(f"{name:24} {count:10}")
+
+
+async def loadtest(args):
+    stats = Stats()
+    redis = coredis.Redis(host=args.redis_host, port=args.redis_port)
+    limits = httpx.Limits(max_connections=args.connections)
+    async with httpx.AsyncClient(
+        base_url=args.url, limits=limits, timeout=args.timeout
+    ) as http:
+        badges = [SimulatedBadge(http, stats, args) for _ in range(args.badges)]
+        build_ir_graph(badges, args.degree)
+
+        before = await commandstats(redis)
+        start = time.monotonic()
+        end_at = start + args.duration
+        await asyncio.gather(
+            *(
+                badge.run(badges, start + random.uniform(0, args.ramp), end_at)
+                for badge in badges
+            )
+        )
+        elapsed = time.monotonic() - start
+        after = await commandstats(redis)
+
+    requests = stats.report(elapsed)
+    report_commands(before, after, requests)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Simulate a fleet of badges against the api server"
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--redis-host", default="127.0.0.1")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--badges", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=120, help="seconds")
+    parser.add_argument(
+        "--ramp", type=float, default=10, help="seconds to spread registrations over"
+    )
+    parser.add_argument("--checkin-period", type=float, default=60)
+    parser.add_argument(
+        "--checkin-jitter", type=float, default=0.1, help="fraction of the period"
+    )
+    parser.add_argument(
+        "--encounter-rate", type=float, default=2, help="IR encounters a minute"
+    )
+    parser.add_argument(
+        "--object-share",
+        type=float,
+        default=0.2,
+        help="fraction of encounters that are hidden objects, same again for monkeys",
+    )
+    parser.add_argument("--degree", type=int, default=8, help="IR graph neighbours")
+    parser.add_argument("--batch-period", type=float, default=7)
+    parser.add_argument(
+        "--no-batch",
+        action="store_true",
+        help="send each call to its own endpoint instead of /batch",
+    )
+    parser.add_argument(
+        "--register-only",
+        action="store_true",
+        help="stop each badge after registering, with --ramp 0 for a pickup burst",
+    )
+    parser.add_argument(
+        "--generate-handle",
+        action="store_true",
+        help="GET /generate_handle before registering, like older firmware",
+    )
+    parser.add_argument("--connections", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=30)
+    asyncio.run(loadtest(parser.parse_args()))
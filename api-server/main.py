@@ -1,28 +1,89 @@
-import json
+import asyncio
 import os
+import queue
 import random
 import secrets
-from fastapi import FastAPI, HTTPException, Security, status, Response, Request
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Security,
+    status,
+    Request,
+    Response,
+)
 from fastapi.security import APIKeyHeader
 from hrid import HRID
 from pydantic import BaseModel
 import coredis
-import uvicorn
+import orjson
+from coredis.pipeline import Pipeline
+from coredis.tokens import PureToken
+import aiomqtt
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
 import re
 import logging
 
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
 
-limiter = Limiter(key_func=get_remote_address)
-app = FastAPI()
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener = start_logging()
+    client = connect_redis()
+    await run_migrations(client)
+    await load_game_phase(client)
+    phase_watcher = asyncio.create_task(watch_game_phase(client))
+    publisher = asyncio.create_task(mqtt_publisher()) if mqtt_host else None
+    yield
+    phase_watcher.cancel()
+    if publisher:
+        publisher.cancel()
+    client.connection_pool.disconnect()
+    log_listener.stop()
+
+
+class OrjsonResponse(Response):
+    """
+    JSON response rendered with orjson.  Endpoints return these directly,
+    which also skips FastAPI's jsonable_encoder pass over the content.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=OrjsonResponse)
 
 
 redishost = os.environ.get("MB_REDIS_HOST", "127.0.0.1")
 redisport = os.environ.get("MB_REDIS_PORT", "6379")
+# connections each worker keeps to redis, requests wait for a free one when
+# they are all busy
+redis_max_connections = int(os.environ.get("MB_REDIS_MAX_CONNECTIONS", "64"))
+# MQTT broker that state change events are published to, leave the host
+# unset to turn the push channel off
+mqtt_host = os.environ.get("MB_MQTT_HOST", "")
+mqtt_port = int(os.environ.get("MB_MQTT_PORT", "1883"))
+loglevel = os.environ.get("MB_LOG_LEVEL", "INFO")
+# fraction of requests (0.0 - 1.0) that also log their response body, error
+# responses always do
+log_sample_rate = float(os.environ.get("MB_LOG_SAMPLE_RATE", "0"))
+log_body_limit = 4096
 
 registration_key = "7bc78281-2036-41b2-8d98-fc23ec504e9a"
 
@@ -32,82 +93,918 @@ uber3uuid = 52321
 uber4uuid = 65001
 uber5uuid = 38913
 
+# challenge2 status index for each hidden object
+hiddenobjects = [uber1uuid, uber2uuid, uber3uuid, uber4uuid, uber5uuid]
+
 monkeys = {"cansuuid": 37634, "micuuid": 31583, "shadesuuid": 51799}
 
 ADMINKEY = "phreakwashere"
 
-templateJSON = """
-{
-    "badgeHandle": "",
-    "current_challenge": "intro",
-    "IR_ID": "",
-    "token": "",
-    "intro": {
-        "enabled": 0,
-        "complete": 0
-    },
-    "challenge1": {
-        "complete": 0,
-        "matches": {}
-    },
-    "challenge2": {
-        "complete": 0,
-        "status": [0,0,0,0,0]
-    },
-    "challenge3": {
-        "complete": 0,
-        "interact_cans": 0,
-        "interact_mic": 0,
-        "interact_shades": 0
-    },
-    "antisocial_monkey_club": 0,
-    "battles": {
-        "won": 0,
-        "lost": 0,
-        "level": 1
-    }
-}
-"""
-logging.basicConfig(level=logging.DEBUG)
+# shared by /generate_handle and /register, creating (and seeding) a new
+# generator for every handle took ten times longer than generating one
+handle_generator = HRID(hridfmt=("adjective", "noun"))
+
+# most operations a badge can send to /batch at once
+max_batch_ops = 16
+# most leaderboard entries returned by one /leaderboard request
+max_leaderboard_limit = 100
+# seconds a response is kept for retries with the same Idempotency-Key, long
+# enough to cover a badge's retries of a queued call
+idempotency_ttl = 600
+
+# Each badge's keys are namespaced: badge_key(uuid) is its json document,
+# irid_key(n) holds the uuid of the badge with IR_ID n and token_key(token)
+# the uuid of the badge the token belongs to.  BADGES is the registry of
+# every badge uuid, so finding the badges never needs KEYS or a SCAN of the
+# whole keyspace.
+BADGES = "badges"
+# layout of the keys above, see migrate_keyspace()
+KEYSPACE_VERSION = "keyspace_version"
+keyspace_version = 2
+
+
+def badge_key(badge_id):
+    return f"badge:{badge_id}"
+
+
+def irid_key(irid):
+    return f"irid:{irid}"
+
+
+def token_key(token):
+    return f"token:{token}"
+
+
+# API keys used to live in the "badge_apikeys" list, and then in the
+# "badge_apikey_index" set with a "badge_token_uuids" hash mapping them to
+# their badge.  Both are migrated to token_key() strings.
+APIKEY_LIST = "badge_apikeys"
+APIKEY_INDEX = "badge_apikey_index"
+TOKEN_UUIDS = "badge_token_uuids"
+
+# game wide state (e.g. whether the intro has started) lives in redis so all
+# workers agree on it.  Each worker caches it in game_phase and reloads it when
+# a change is published on GAME_PHASE_CHANNEL.
+GAME_PHASE = "game_phase"
+GAME_PHASE_CHANNEL = "game_phase_changed"
+game_phase = {}
+
+# IR_IDs not assigned to a badge, registration SPOPs one and /deletebadge
+# puts it back.  IDs used by the hidden objects and monkeys are never handed
+# out.
+IRID_POOL = "irid_pool"
+IRID_POOL_SEEDED = "irid_pool_seeded"
+
+# badges that have completed the intro, scored 1000/2000/3000 for each
+# completed challenge plus one per friend.  Every write that changes a score
+# updates it in the same transaction.
+LEADERBOARD = "leaderboard"
+# paths whose changes can move a badge on the leaderboard
+score_paths = ("$.intro", "$.challenge", "$.current_challenge")
+# a badge's id is published here after anything that can change its row on
+# the scoreboard (score, handle, pairing, deletion), and an empty message
+# after a rebuild, so the scoreboard can refresh on changes rather than
+# polling
+LEADERBOARD_CHANNEL = "leaderboard_changed"
+board_paths = (*score_paths, "$.badgeHandle")
+
+# the friend graph, friends_key(uuid) is the set of uuids a badge has paired
+# with.  Pairing checks and friend counts use the sets, challenge1.matches in
+# the document stays as the badge's copy of its friends.
+FRIENDS_BACKFILLED = "friends_backfilled"
+
+
+def friends_key(badge_id):
+    return f"friends:{badge_id}"
+
+
+async def chunked(items, size):
+    """
+    Collects an async iterator into lists of up to `size` items
+    """
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def badge_id_chunks(client, size=500):
+    """
+    Yields the uuid of every registered badge, `size` at a time, for the
+    caller to fetch with a JSON.MGET or pipeline
+    """
+    badge_ids = client.sscan_iter(BADGES, count=size)
+    async for chunk in chunked(badge_ids, size):
+        yield [badge_id.decode() for badge_id in chunk]
+
+
+def match_uuids(matches):
+    """
+    The friends' uuids in a badge's challenge1.matches
+    """
+    if isinstance(matches, dict):
+        matches = matches.values()
+    return [m["uuid"] for m in matches or () if isinstance(m, dict) and "uuid" in m]
+
+
+# held while a worker runs the startup migrations, set to a token only that
+# worker knows and kept alive every third of MIGRATION_LOCK_TTL seconds
+MIGRATION_LOCK = "startup_migrations"
+MIGRATION_LOCK_TTL = 30
+
+
+class Intro(BaseModel):
+    enabled: int = 0
+    complete: int = 0
+
+
+class Match(BaseModel):
+    handle: str
+    uuid: str
+
+
+class Challenge1(BaseModel):
+    complete: int = 0
+    # IR_ID of each friend -> who they are
+    matches: dict[str, Match] = {}
+
+
+class Challenge2(BaseModel):
+    complete: int = 0
+    # found flag for each of hiddenobjects
+    status: list[int] = [0, 0, 0, 0, 0]
+
+
+class Challenge3(BaseModel):
+    complete: int = 0
+    interact_cans: int = 0
+    interact_mic: int = 0
+    interact_shades: int = 0
+
+
+class Battles(BaseModel):
+    won: int = 0
+    lost: int = 0
+    level: int = 1
+
+
+class BadgeState(BaseModel):
+    """
+    A badge's json document as stored in redis and returned to the badge
+    """
+
+    badgeHandle: str = ""
+    current_challenge: str = "intro"
+    IR_ID: int | str = ""
+    token: str = ""
+    intro: Intro = Intro()
+    challenge1: Challenge1 = Challenge1()
+    challenge2: Challenge2 = Challenge2()
+    challenge3: Challenge3 = Challenge3()
+    antisocial_monkey_club: int = 0
+    battles: Battles = Battles()
+    # only present while the badge is in monkey mode
+    monkey_id: int | None = None
+    state_version: int = 1
+
+
+# the document every new badge starts from, see new_badge()
+badge_template = BadgeState().model_dump(exclude_none=True)
+
+
+def new_badge():
+    """
+    Returns a fresh copy of badge_template.  The template is at most two
+    levels deep, copying it by hand is cheaper than copy.deepcopy() or
+    parsing it from json again.
+    """
+    j = {}
+    for key, value in badge_template.items():
+        if isinstance(value, dict):
+            value = {
+                k: v.copy() if isinstance(v, (dict, list)) else v
+                for k, v in value.items()
+            }
+        j[key] = value
+    return j
+
+
 logger = logging.getLogger(__name__)
 
 
+def start_logging():
+    """
+    Hands log records to a queue written by a listener thread, so request
+    handlers never block the event loop on log I/O.  Called from the
+    lifespan rather than at import, so admin.py and loadtest.py can import
+    this module without records piling up in a queue nothing reads.
+
+    returns the started listener, stop it to flush the queue
+    """
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, logging.StreamHandler())
+    # basicConfig puts its formatter on the QueueHandler, records reach the
+    # listener's handler already formatted
+    logging.basicConfig(level=loglevel, handlers=[QueueHandler(log_queue)], force=True)
+    log_listener.start()
+    return log_listener
+
+
+# Served from /metrics.  Each worker keeps its own, set PROMETHEUS_MULTIPROC_DIR
+# to an empty directory when running several so /metrics can add them up.
+requests_total = Counter(
+    "monkeybadge_requests_total", "Requests handled", ["route", "method", "status"]
+)
+request_latency = Histogram(
+    "monkeybadge_request_duration_seconds", "Request latency", ["route"]
+)
+requests_in_progress = Gauge(
+    "monkeybadge_requests_in_progress",
+    "Requests being handled",
+    multiprocess_mode="livesum",
+)
+redis_commands_total = Counter(
+    "monkeybadge_redis_commands_total",
+    "Redis round trips made by requests, a pipeline counts once",
+    ["route", "command"],
+)
+redis_latency = Histogram(
+    "monkeybadge_redis_command_duration_seconds",
+    "Redis round trip latency",
+    ["command"],
+)
+redis_calls_per_request = Histogram(
+    "monkeybadge_redis_calls_per_request",
+    "Redis round trips made by each request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20),
+)
+redis_time_per_request = Histogram(
+    "monkeybadge_redis_seconds_per_request",
+    "Time each request spent waiting on redis",
+    ["route"],
+)
+# (command, seconds) for every redis round trip made by the current request,
+# appended to by InstrumentedRedis
+redis_calls = ContextVar("redis_calls", default=None)
+
+
+async def log_with_body(body_iterator, log_message):
+    """
+    Passes the response body through untouched, keeping a copy of the first
+    log_body_limit bytes to log once the response has been sent.
+    """
+    body = b""
+    async for chunk in body_iterator:
+        if len(body) < log_body_limit:
+            body += chunk[: log_body_limit - len(body)]
+        yield chunk
+
+    log_message["response"] = body.decode(errors="replace")
+    logger.info(log_message)
+
+
+async def store_with_body(body_iterator, key, status_code):
+    chunks = []
+    async for chunk in body_iterator:
+        chunks.append(chunk)
+        yield chunk
+    await client.set(key, b"%d " % status_code + b"".join(chunks), ex=idempotency_ttl)
+
+
 @app.middleware("http")
-async def api_logging(request: Request, call_next):
-    response = await call_next(request)
+async def idempotency(request: Request, call_next):
+    """
+    Saves the response of a request the idempotent dependency reserved a key
+    for, so a retry with the same key gets it back.  Server errors and rate
+    limits aren't saved, their reservation is dropped so a retry runs the
+    request again.
+    """
+    try:
+        response = await call_next(request)
+    except Exception:
+        key = getattr(request.state, "idempotency_key", None)
+        if key:
+            await client.delete([key])
+        raise
+    key = getattr(request.state, "idempotency_key", None)
+    if key and response.status_code < 500 and response.status_code != 429:
+        response.body_iterator = store_with_body(
+            response.body_iterator, key, response.status_code
+        )
+    elif key:
+        await client.delete([key])
+    return response
 
-    response_body = b""
-    async for chunk in response.body_iterator:
-        response_body += chunk
+
+@app.middleware("http")
+async def api_logging(request: Request, call_next):
+    start = time.perf_counter()
+    calls = []
+    redis_calls.set(calls)
+    requests_in_progress.inc()
+    try:
+        response = await call_next(request)
+    finally:
+        requests_in_progress.dec()
+    latency = time.perf_counter() - start
+
+    route = request.scope.get("route")
     log_message = {
-        "host": request.url.hostname,
-        "headers": request.headers,
-        "endpoint": request.url.path,
-        "response": response_body.decode(),
+        "host": request.client.host if request.client else None,
+        "endpoint": route.path if route else request.url.path,
+        "status": response.status_code,
+        "latency_ms": round(latency * 1000, 2),
+        "badge": getattr(request.state, "badge_id", None),
     }
-    logger.debug(log_message)
-    return Response(
-        content=response_body,
-        status_code=response.status_code,
-        headers=dict(response.headers),
-        media_type=response.media_type,
-    )
+
+    # unmatched paths share a label so scanners can't blow up the metrics
+    label = route.path if route else "unmatched"
+    requests_total.labels(label, request.method, response.status_code).inc()
+    request_latency.labels(label).observe(latency)
+    for command, _ in calls:
+        redis_commands_total.labels(label, command).inc()
+    redis_calls_per_request.labels(label).observe(len(calls))
+    redis_time_per_request.labels(label).observe(sum(t for _, t in calls))
+
+    if response.status_code >= 400 or random.random() < log_sample_rate:
+        response.body_iterator = log_with_body(response.body_iterator, log_message)
+    else:
+        logger.info(log_message)
+
+    return response
+
+
+async def seed_irid_pool(client):
+    """
+    Fills IRID_POOL with every 16 bit IR_ID that isn't already assigned.
+    Runs under MIGRATION_LOCK until it has finished once, IRID_POOL_SEEDED is
+    only set after the last ID is added so an interrupted seed starts over.
+    """
+    if await client.exists([IRID_POOL_SEEDED]):
+        return
+
+    used = {0, *hiddenobjects, *monkeys.values()}
+    async for chunk in badge_id_chunks(client):
+        irids = await client.json.mget([badge_key(b) for b in chunk], ".IR_ID")
+        used.update(int(irid) for irid in irids if irid not in (None, ""))
+
+    free = [irid for irid in range(1 << 16) if irid not in used]
+    await client.delete([IRID_POOL])
+    for i in range(0, len(free), 5000):
+        await client.sadd(IRID_POOL, free[i : i + 5000])
+    await client.set(IRID_POOL_SEEDED, "1")
+    logger.info(f"seeded {IRID_POOL} with {len(free)} IR_IDs")
+
+
+async def release_irid(client, irid):
+    """
+    Removes the IR_ID -> uuid mapping and returns the IR_ID to the pool
+    """
+    await client.delete([irid_key(irid)])
+    await client.sadd(IRID_POOL, [irid])
 
 
 def check_intro_started():
     """
-    Check if the intro challenge has been started by looking for the
-    existance of a drop file
+    Check if the intro challenge has been started.  This reads the cached
+    game phase, so it's safe to call on every request.
+    """
+    return game_phase.get("intro_started", False)
+
+
+async def load_game_phase(client):
+    """
+    Refreshes the cached game phase from redis
+    """
+    phase = await client.hgetall(GAME_PHASE)
+    game_phase["intro_started"] = phase.get(b"intro_started") == b"1"
+
+
+async def set_game_phase(client, **fields):
+    """
+    Stores the game phase in redis and tells every worker to reload it
+    """
+    await client.hset(GAME_PHASE, {k: int(v) for k, v in fields.items()})
+    await client.publish(GAME_PHASE_CHANNEL, ",".join(fields))
+    game_phase.update(fields)
+
+
+async def migrate_game_phase(client):
+    """
+    The intro used to be started by writing an "intro_started" drop file in
+    the working directory, carry that over to redis if it's still around.
     """
     if os.path.exists("intro_started"):
-        return True
-    else:
-        return False
+        await set_game_phase(client, intro_started=True)
+        os.remove("intro_started")
+        logger.info("migrated intro_started drop file to redis")
+
+
+async def watch_game_phase(client):
+    """
+    Keeps the cached game phase in sync with redis.  The phase is reloaded
+    whenever a change is published, and after every (re)subscribe so changes
+    made while disconnected aren't missed.
+    """
+    while True:
+        try:
+            pubsub = client.pubsub()
+            await pubsub.subscribe(GAME_PHASE_CHANNEL)
+            await load_game_phase(client)
+            while True:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=30
+                )
+                if message:
+                    await load_game_phase(client)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.warning(f"game phase watcher: {err}, reconnecting")
+            await asyncio.sleep(1)
+
+
+# Badges subscribe to their own topic and the broadcast topic, and check in
+# as soon as anything arrives on either.  Events only say that something
+# changed, the state itself (and anything secret) still comes from /checkin.
+MQTT_BADGE_TOPIC = "monkeybadge/badge/{}"
+MQTT_BROADCAST_TOPIC = "monkeybadge/broadcast"
+# events waiting for mqtt_publisher(), new ones are dropped when it's full
+# since the badges still poll
+mqtt_queue = asyncio.Queue(maxsize=10000)
+
+
+def notify(topic, event):
+    """
+    Queues an event for the MQTT publisher, never waits on the broker
+    """
+    if not mqtt_host:
+        return
+    try:
+        mqtt_queue.put_nowait((topic, orjson.dumps(event)))
+    except asyncio.QueueFull:
+        logger.warning(f"mqtt queue full, dropping event for {topic}")
+
+
+def notify_badge(badge_id):
+    notify(MQTT_BADGE_TOPIC.format(badge_id), {"event": "state"})
+
+
+async def mqtt_publisher():
+    """
+    Publishes queued events, reconnecting whenever the broker goes away.  An
+    event being published when the connection drops is lost, the badge picks
+    the change up on its next checkin.
+    """
+    while True:
+        try:
+            async with aiomqtt.Client(hostname=mqtt_host, port=mqtt_port) as mqtt:
+                logger.info(f"mqtt publisher connected to {mqtt_host}:{mqtt_port}")
+                while True:
+                    topic, payload = await mqtt_queue.get()
+                    await mqtt.publish(topic, payload)
+        except asyncio.CancelledError:
+            raise
+        except aiomqtt.MqttError as err:
+            logger.warning(f"mqtt publisher: {err}, reconnecting")
+            await asyncio.sleep(1)
 
 
 api_key_header = APIKeyHeader(name="X-API-Key")
 
-client = coredis.Redis(host=redishost, port=int(redisport))
+# every worker creates its own client and registers the lua scripts below
+# with it at startup, see connect_redis()
+client = None
+
+
+def record_redis_call(command, start):
+    seconds = time.perf_counter() - start
+    redis_latency.labels(command).observe(seconds)
+    calls = redis_calls.get()
+    if calls is not None:
+        calls.append((command, seconds))
+
+
+class InstrumentedPipeline(Pipeline):
+    """
+    Pipeline whose `async with` hands out the pipeline itself, where coredis
+    hands out the implementation it wraps.  A Script called with
+    client=pipe only has execute() SCRIPT LOAD it when redis lacks it if
+    pipe is a Pipeline, otherwise the EVALSHA fails with NOSCRIPT.
+    """
+
+    async def __aenter__(self):
+        await self.__wrapped__.__aenter__()
+        return self
+
+
+class InstrumentedRedis(coredis.Redis):
+    """
+    coredis client that times every command, and every pipeline as a single
+    MULTI or PIPELINE command, for the request metrics
+    """
+
+    async def execute_command(self, command, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(command, *args, **options)
+        finally:
+            record_redis_call(bytes(command).decode(), start)
+
+    async def pipeline(self, transaction=True, watches=None, timeout=None):
+        pipe = await super().pipeline(transaction, watches, timeout)
+        # the proxy's execute calls the implementation's, so that is the one
+        # to time
+        impl = pipe.__wrapped__
+        execute = impl.execute
+
+        async def timed_execute(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await execute(*args, **kwargs)
+            finally:
+                record_redis_call("MULTI" if transaction else "PIPELINE", start)
+
+        impl.execute = timed_execute
+        return InstrumentedPipeline(impl)
+
+
+# shared by the scripts that change a badge's progress, score_badge(key,
+# friends, leaderboard, badge_id) writes the badge's current score into the
+# leaderboard
+SCORE_BADGE_FUNCTION = """
+local function score_badge(key, friends, leaderboard, badge_id)
+    local function complete(path)
+        return cjson.decode(redis.call('JSON.GET', key, path)) == 1
+    end
+
+    if not complete('.intro.complete') then
+        return
+    end
+
+    local score = redis.call('SCARD', friends)
+    if complete('.challenge1.complete') then
+        score = score + 1000
+    end
+    if complete('.challenge2.complete') then
+        score = score + 2000
+    end
+    if complete('.challenge3.complete') then
+        score = score + 3000
+    end
+    redis.call('ZADD', leaderboard, score, badge_id)
+end
+"""
+
+# KEYS=[badge, friends, leaderboard] ARGV=[badge id]
+SCORE_BADGE_LUA = (
+    SCORE_BADGE_FUNCTION
+    + """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    score_badge(KEYS[1], KEYS[2], KEYS[3], ARGV[1])
+end
+"""
+)
+
+# Pairs KEYS[1] (ARGV[1]) with KEYS[2] (ARGV[2], IR_ID ARGV[3]).  Each badge
+# is added to the other's friend set (KEYS[3] and KEYS[4]) and
+# challenge1.matches, and moved on to challenge2 once it has 5 friends.
+# Runs server side so the sets and both documents change atomically.
+# KEYS[5] is the leaderboard.
+#
+# returns {"paired", <json of KEYS[1]>}, {"friends"} or {"missing"}
+PAIR_BADGES_LUA = (
+    SCORE_BADGE_FUNCTION
+    + """
+if redis.call('EXISTS', KEYS[1]) == 0 or redis.call('EXISTS', KEYS[2]) == 0 then
+    return {'missing'}
+end
+
+if redis.call('SISMEMBER', KEYS[3], ARGV[2]) == 1 then
+    return {'friends'}
+end
+
+local my_irid = tostring(cjson.decode(redis.call('JSON.GET', KEYS[1], '.IR_ID')))
+local my_path = '$.challenge1.matches["' .. ARGV[3] .. '"]'
+local remote_path = '$.challenge1.matches["' .. my_irid .. '"]'
+
+local my_handle = cjson.decode(redis.call('JSON.GET', KEYS[1], '.badgeHandle'))
+local remote_handle = cjson.decode(redis.call('JSON.GET', KEYS[2], '.badgeHandle'))
+
+redis.call('JSON.SET', KEYS[1], my_path,
+    cjson.encode({handle = remote_handle, uuid = ARGV[2]}))
+redis.call('JSON.SET', KEYS[2], remote_path,
+    cjson.encode({handle = my_handle, uuid = ARGV[1]}))
+redis.call('SADD', KEYS[3], ARGV[2])
+redis.call('SADD', KEYS[4], ARGV[1])
+
+for i, key in ipairs({KEYS[1], KEYS[2]}) do
+    local friends = KEYS[i + 2]
+    local challenge = cjson.decode(redis.call('JSON.GET', key, '.current_challenge'))
+    if challenge == 'challenge1' and redis.call('SCARD', friends) >= 5 then
+        redis.call('JSON.SET', key, '.challenge1.complete', '1')
+        redis.call('JSON.SET', key, '.current_challenge', '"challenge2"')
+    end
+
+    if #redis.call('JSON.TYPE', key, '$.state_version') > 0 then
+        redis.call('JSON.NUMINCRBY', key, '$.state_version', 1)
+    else
+        redis.call('JSON.SET', key, '$.state_version', 1)
+    end
+
+    score_badge(key, friends, KEYS[5], ARGV[i])
+end
+
+return {'paired', redis.call('JSON.GET', KEYS[1], '.')}
+"""
+)
+
+# Moves the badge KEYS[1] (ARGV[1]) on to challenge3 once every hidden object
+# is found, and on to winner once it has seen every monkey in challenge3.
+# Decided from the document in redis, in the same MULTI as the write of the
+# status, so concurrent requests finding the last two objects can't both
+# miss it.  KEYS[2] is the badge's friend set, KEYS[3] the leaderboard and
+# ARGV[2] the channel a rescored badge is published on.
+#
+# returns the challenge the badge moved on to, or nil
+COMPLETE_CHALLENGES_LUA = (
+    SCORE_BADGE_FUNCTION
+    + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+
+local function get(path)
+    return cjson.decode(redis.call('JSON.GET', KEYS[1], path))
+end
+
+local moved = nil
+if get('.current_challenge') == 'challenge2' then
+    local status = get('.challenge2.status')
+    local found = #status == 5
+    for _, s in ipairs(status) do
+        found = found and s == 1
+    end
+    if found then
+        redis.call('JSON.SET', KEYS[1], '.challenge2.complete', '1')
+        redis.call('JSON.SET', KEYS[1], '.current_challenge', '"challenge3"')
+        moved = 'challenge3'
+    end
+end
+
+if get('.current_challenge') == 'challenge3'
+    and get('.challenge3.interact_cans') == 1
+    and get('.challenge3.interact_mic') == 1
+    and get('.challenge3.interact_shades') == 1 then
+    redis.call('JSON.SET', KEYS[1], '.challenge3.complete', '1')
+    redis.call('JSON.SET', KEYS[1], '.current_challenge', '"winner"')
+    moved = 'winner'
+end
+
+if moved then
+    if #redis.call('JSON.TYPE', KEYS[1], '$.state_version') > 0 then
+        redis.call('JSON.NUMINCRBY', KEYS[1], '$.state_version', 1)
+    else
+        redis.call('JSON.SET', KEYS[1], '$.state_version', 1)
+    end
+    score_badge(KEYS[1], KEYS[2], KEYS[3], ARGV[1])
+    redis.call('PUBLISH', ARGV[2], ARGV[1])
+end
+return moved
+"""
+)
+
+# Sliding window rate limit: counts for the current and previous fixed
+# windows are kept as fields of one hash, and the previous window's count is
+# weighted by how much of it still overlaps the sliding window.  Redis' clock
+# is used so every worker and host agrees on the windows.
+# KEYS=[counter hash] ARGV=[limit, period in seconds]
+# returns 0 if the request is allowed, otherwise seconds to wait
+RATE_LIMIT_LUA = """
+local limit = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local window = math.floor(now / period)
+local remaining = 1 - (now - window * period) / period
+
+local counts = redis.call('HMGET', KEYS[1], window, window - 1)
+local current = tonumber(counts[1]) or 0
+local previous = tonumber(counts[2]) or 0
+if current + previous * remaining >= limit then
+    return math.max(1, math.ceil(remaining * period))
+end
+
+redis.call('HINCRBY', KEYS[1], window, 1)
+redis.call('HDEL', KEYS[1], window - 2)
+redis.call('EXPIRE', KEYS[1], period * 2)
+return 0
+"""
+
+# KEYS=[lock] ARGV=[token, seconds]
+# resets the lock's expiry if the token still holds it, returns 1 if it did
+EXTEND_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS=[lock] ARGV=[token]
+# deletes the lock if the token still holds it, so a worker whose lock
+# expired can't release one another worker has taken since
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS=[token] ARGV=[badge id]
+# Claims a token a badge registers with, if it was emptied by deleting its
+# badge or already belongs to this badge.  Checked and set in one step so a
+# token can't be taken from a live badge.
+# returns 1 if the token is the badge's, otherwise 0
+REUSE_TOKEN_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if owner == '' or owner == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# KEYS=[token, idempotency key] ARGV=[seconds to keep it]
+# Looks up the response saved under an Idempotency-Key, or reserves the key
+# with an empty value for the request about to run.  Tokens that don't
+# belong to a badge reserve nothing.
+# returns {"saved", <response>}, {"running"}, {"reserved"} or {"unknown"}
+IDEMPOTENCY_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if not owner or owner == '' then
+    return {'unknown'}
+end
+
+local saved = redis.call('GET', KEYS[2])
+if saved == '' then
+    return {'running'}
+elseif saved then
+    return {'saved', saved}
+end
+
+redis.call('SET', KEYS[2], '', 'EX', ARGV[1])
+return {'reserved'}
+"""
+
+
+def connect_redis():
+    """
+    Creates this worker's pooled redis client and registers the lua scripts
+    with it.  Scripts run in pipelines are passed client=pipe, which sends
+    them by sha (loading any the server lacks first) rather than as source.
+    """
+    global client, claim_idempotency_key, complete_challenges, pair_badges
+    global rate_limit, reuse_token, score_badge
+
+    client = InstrumentedRedis(
+        host=redishost,
+        port=int(redisport),
+        max_connections=redis_max_connections,
+        connection_pool_cls=coredis.BlockingConnectionPool,
+    )
+    pair_badges = client.register_script(PAIR_BADGES_LUA)
+    complete_challenges = client.register_script(COMPLETE_CHALLENGES_LUA)
+    score_badge = client.register_script(SCORE_BADGE_LUA)
+    rate_limit = client.register_script(RATE_LIMIT_LUA)
+    claim_idempotency_key = client.register_script(IDEMPOTENCY_LUA)
+    reuse_token = client.register_script(REUSE_TOKEN_LUA)
+    return client
+
+
+async def get_badge(request: Request, api_key: str = Security(api_key_header)) -> dict:
+    """
+    Authenticates the API key and loads the badge named by myUUID in the
+    request body.  The token lookup and the document fetch share a single
+    pipelined round trip.
+
+    returns the badge's json structure
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid request body")
+
+    uuid = body.get("myUUID") if isinstance(body, dict) else None
+    if not isinstance(uuid, str) or not uuid:
+        raise HTTPException(status_code=400, detail="myUUID missing")
+    request.state.badge_id = uuid
+
+    async with await client.pipeline(transaction=False) as pipe:
+        await pipe.get(token_key(api_key))
+        await pipe.json.get(badge_key(uuid), ".")
+        owner, j = await pipe.execute()
+
+    if owner is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or missing API Key",
+        )
+
+    # the token of a deleted badge is kept but emptied, a 404 tells the
+    # badge to register again with it
+    if not owner:
+        raise HTTPException(status_code=404, detail="Badge not found")
+
+    if not j:
+        raise HTTPException(status_code=404, detail="Badge not found")
+
+    if owner.decode() != uuid or not isinstance(j, dict) or j.get("token") != api_key:
+        raise HTTPException(status_code=404, detail="Badge not found")
+
+    return j
+
+
+class RateLimit:
+    """
+    Dependency limiting an endpoint to `limit` requests every `period`
+    seconds for each badge token, shared by every worker through redis.
+    Only authenticated requests are counted, so unknown tokens don't leave
+    counters behind.
+    """
+
+    def __init__(self, name, limit, period=60):
+        self.name = name
+        self.limit = limit
+        self.period = period
+
+    async def __call__(
+        self,
+        api_key: str = Security(api_key_header),
+        badge: dict = Depends(get_badge),
+    ):
+        retry_after = await rate_limit(
+            keys=[f"ratelimit:{self.name}:{api_key}"],
+            args=[self.limit, self.period],
+        )
+        if retry_after:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Rate limit exceeded: {self.limit} per {self.period} seconds",
+                headers={"Retry-After": str(retry_after)},
+            )
+
+
+class Replay(Exception):
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+
+@app.exception_handler(Replay)
+async def replay_response(request: Request, exc: Replay):
+    return Response(
+        exc.body,
+        status_code=exc.status_code,
+        media_type="application/json",
+        headers={"Idempotent-Replay": "true"},
+    )
+
+
+async def idempotent(
+    request: Request,
+    api_key: str = Security(api_key_header),
+    idempotency_key: str | None = Header(default=None, max_length=64),
+):
+    """
+    Dependency making a badge mutation safe to retry.  A request with an
+    Idempotency-Key header that was already answered gets the saved response
+    back from a single IDEMPOTENCY_LUA call, before the badge is loaded or
+    rate limited.  Otherwise the key is reserved while the request runs and
+    the same key sent again meanwhile gets a 409.  Keys are scoped to the
+    badge token and kept for `idempotency_ttl` seconds, nothing is kept for
+    unknown tokens.  Requests without the header run as usual.
+    """
+    if not idempotency_key:
+        return
+    key = f"idempotency:{api_key}:{idempotency_key}"
+    result, *saved = await claim_idempotency_key(
+        keys=[token_key(api_key), key], args=[idempotency_ttl]
+    )
+    if result == b"saved":
+        status_code, body = saved[0].split(b" ", 1)
+        raise Replay(int(status_code), body)
+    if result == b"running":
+        raise HTTPException(
+            status_code=409, detail="A request with this Idempotency-Key is running"
+        )
+    # an unknown token is turned away by get_badge
+    if result == b"reserved":
+        request.state.idempotency_key = key
 
 
 class Admin(BaseModel):
@@ -129,8 +1026,13 @@ class Handle(BaseModel):
 class Register(BaseModel):
     myUUID: str
     key: str
-    handle: str
-    token: str
+    handle: str = ""
+    token: str = ""
+
+
+class DeleteBadge(BaseModel):
+    myUUID: str
+    key: str
 
 
 class UUID_ObjectID(BaseModel):
@@ -147,25 +1049,231 @@ class OnlyUUID(BaseModel):
     myUUID: str
 
 
-async def does_api_key_exist(client, api_key: str) -> bool:
-    apikeys = await client.lrange("badge_apikeys", 0, -1)
+class BatchOp(BaseModel):
+    op: str
+    remoteIRID: str = ""
+    objectid: int = 0
+
+
+class Batch(BaseModel):
+    myUUID: str
+    ops: list[BatchOp]
+
+
+async def run_migrations(client):
+    """
+    Runs the startup migrations and backfills.  Every worker on every host
+    runs them at startup, MIGRATION_LOCK keeps them from racing each other
+    and each one is a no-op once it has been done.  The lock is renewed for
+    as long as the migrations take, and expires if the worker dies.
+    """
+    token = secrets.token_hex(16)
+    while not await client.set(
+        MIGRATION_LOCK, token, condition=PureToken.NX, ex=MIGRATION_LOCK_TTL
+    ):
+        await asyncio.sleep(0.1)
+
+    extend_lock = client.register_script(EXTEND_LOCK_LUA)
+    release_lock = client.register_script(RELEASE_LOCK_LUA)
+
+    async def keep_lock():
+        while True:
+            await asyncio.sleep(MIGRATION_LOCK_TTL / 3)
+            if not await extend_lock(
+                keys=[MIGRATION_LOCK], args=[token, MIGRATION_LOCK_TTL]
+            ):
+                logger.warning(f"lost {MIGRATION_LOCK} while migrating")
+                return
+
+    keeper = asyncio.create_task(keep_lock())
+    try:
+        await migrate_api_keys(client)
+        await migrate_keyspace(client)
+        await migrate_game_phase(client)
+        await seed_irid_pool(client)
+        await backfill_friends(client)
+        await backfill_leaderboard(client)
+    finally:
+        keeper.cancel()
+        await release_lock(keys=[MIGRATION_LOCK], args=[token])
+
+
+async def migrate_api_keys(client):
+    """
+    One time migration of the legacy "badge_apikeys" list into the
+    APIKEY_INDEX set.  The list is removed once it has been copied so later
+    startups skip straight past this.
+    """
+    apikeys = await client.lrange(APIKEY_LIST, 0, -1)
     if not apikeys:
-        return False
-    else:
-        for i in apikeys:
-            if i.decode() == api_key:
-                return True
-        return False
+        return
 
+    await client.sadd(APIKEY_INDEX, apikeys)
+    await client.delete([APIKEY_LIST])
+    logger.info(f"migrated {len(apikeys)} api keys to {APIKEY_INDEX}")
 
-async def get_api_key(api_key_header: str = Security(api_key_header)) -> str:
-    if await does_api_key_exist(client, api_key_header):
-        return api_key_header
+
+async def migrate_keyspace(client):
+    """
+    Moves badges from the old flat layout (documents under their uuid,
+    IR_IDs under their number, tokens in APIKEY_INDEX and TOKEN_UUIDS) to
+    the namespaced keys, and registers them in BADGES.  Picks up where it
+    left off if interrupted, KEYSPACE_VERSION marks it done.
+    """
+    if int(await client.get(KEYSPACE_VERSION) or 0) >= keyspace_version:
+        return
+
+    count = 0
+    documents = client.scan_iter(type_="ReJSON-RL", count=500)
+    async for chunk in chunked(documents, 500):
+        chunk = [key.decode() for key in chunk if not key.startswith(b"badge:")]
+        if not chunk:
+            continue
+        irids = await client.json.mget(chunk, ".IR_ID")
+        tokens = await client.json.mget(chunk, ".token")
+        async with await client.pipeline(transaction=True) as pipe:
+            for badge_id, irid, token in zip(chunk, irids, tokens):
+                await pipe.rename(badge_id, badge_key(badge_id))
+                await pipe.sadd(BADGES, [badge_id])
+                if irid not in (None, ""):
+                    await pipe.delete([f"{irid}"])
+                    await pipe.set(irid_key(irid), badge_id)
+                if token:
+                    await pipe.set(token_key(token), badge_id)
+            await pipe.execute()
+        count += len(chunk)
+
+    # IR_IDs and tokens left behind by deleted badges
+    async for key in client.scan_iter(match="[0-9]*", type_="string"):
+        if key.isdigit():
+            await client.rename(key, irid_key(key.decode()))
+    async for token in client.sscan_iter(APIKEY_INDEX):
+        await client.set(token_key(token.decode()), "", condition=PureToken.NX)
+    await client.delete([APIKEY_INDEX, TOKEN_UUIDS])
+
+    await client.set(KEYSPACE_VERSION, keyspace_version)
+    logger.info(f"moved {count} badges to the namespaced keys")
+
+
+async def backfill_friends(client):
+    """
+    Builds the friend sets from the challenge1.matches already in the badge
+    documents.  FRIENDS_BACKFILLED marks it done and is only set once every
+    badge has been through, SADD makes a rerun after an interruption safe.
+    """
+    if await client.exists([FRIENDS_BACKFILLED]):
+        return
+
+    count = 0
+    async for chunk in badge_id_chunks(client):
+        keys = [badge_key(badge_id) for badge_id in chunk]
+        matches = await client.json.mget(keys, ".challenge1.matches")
+        async with await client.pipeline(transaction=False) as pipe:
+            for badge_id, badge_matches in zip(chunk, matches):
+                uuids = match_uuids(badge_matches)
+                if uuids:
+                    await pipe.sadd(friends_key(badge_id), uuids)
+                    count += 1
+            await pipe.execute()
+    await client.set(FRIENDS_BACKFILLED, "1")
+    logger.info(f"backfilled friend sets for {count} badges")
+
+
+async def rebuild_leaderboard(client):
+    """
+    Rebuilds LEADERBOARD from every badge document.  The new set is built
+    under a temporary key and renamed over the old one, so readers never see
+    it half built.
+    """
+    building = f"{LEADERBOARD}:rebuild"
+    await client.delete([building])
+
+    async for chunk in badge_id_chunks(client):
+        async with await client.pipeline(transaction=False) as pipe:
+            for badge_id in chunk:
+                await score_badge(
+                    keys=[badge_key(badge_id), friends_key(badge_id), building],
+                    args=[badge_id],
+                    client=pipe,
+                )
+            await pipe.execute()
+
+    if await client.exists([building]):
+        await client.rename(building, LEADERBOARD)
     else:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid or missing API Key",
+        await client.delete([LEADERBOARD])
+    # every row may have changed
+    await client.publish(LEADERBOARD_CHANNEL, "")
+
+    count = await client.zcard(LEADERBOARD)
+    logger.info(f"rebuilt {LEADERBOARD} with {count} badges")
+    return count
+
+
+async def backfill_leaderboard(client):
+    """
+    Builds LEADERBOARD from the badge documents already in redis.  Only runs
+    when the set doesn't exist yet.
+    """
+    if await client.exists([LEADERBOARD]):
+        return
+
+    await rebuild_leaderboard(client)
+
+
+async def update_badge(badge_id, j, changes, removed=()):
+    """
+    Writes only the changed fields of a badge document and bumps its
+    state_version.
+
+    changes maps JSON paths (e.g. "$.challenge2.status[2]") to their new
+    values and removed lists paths to delete, all of which are applied in a
+    single MULTI/EXEC.  j is the caller's copy of the document, its
+    state_version is updated to match redis.
+    """
+    if not changes and not removed:
+        return
+
+    async with await client.pipeline(transaction=True) as pipe:
+        await queue_badge_update(pipe, badge_id, j, changes, removed)
+        result = await pipe.execute()
+
+    version = result[-1]
+    j["state_version"] = int(version[0]) if isinstance(version, list) else 1
+
+
+async def queue_badge_update(pipe, badge_id, j, changes, removed=()):
+    """
+    Queues the commands for update_badge on an existing pipeline, the last
+    one queued is the state_version bump.
+    """
+    key = badge_key(badge_id)
+    for path, value in changes.items():
+        await pipe.json.set(key, path, value)
+    for path in removed:
+        await pipe.json.delete(key, path)
+    if any(path.startswith(score_paths) for path in [*changes, *removed]):
+        await score_badge(
+            keys=[key, friends_key(badge_id), LEADERBOARD],
+            args=[badge_id],
+            client=pipe,
         )
+    if any(path.startswith(board_paths) for path in [*changes, *removed]):
+        await pipe.publish(LEADERBOARD_CHANNEL, badge_id)
+    if "state_version" in j:
+        await pipe.json.numincrby(key, "$.state_version", 1)
+    else:
+        # documents from before versioning start at 1
+        await pipe.json.set(key, "$.state_version", 1)
+
+
+def state_etag(j):
+    """
+    ETag for a badge document, None for documents without a state_version
+    """
+    if "state_version" in j:
+        return f'"{int(j["state_version"])}"'
+    return None
 
 
 async def validBadge(badge_id):
@@ -173,18 +1281,14 @@ async def validBadge(badge_id):
     # return true if valid
     # return false if not valid
 
-    j = await client.json.get(badge_id, ".")
-    if not j:
-        return False
-    else:
-        return True
+    return bool(await client.sismember(BADGES, badge_id))
 
 
 async def validateKey(badge_id, key):
     # check if the key is valid for the badge_id
     # if valid, return true
     # if invalid, return false
-    j = await client.json.get(badge_id, ".")
+    j = await client.json.get(badge_key(badge_id), ".")
     if not j:
         return False
     else:
@@ -195,32 +1299,24 @@ async def validateKey(badge_id, key):
 
 
 @app.get("/generate_handle")
-def generate_handle():
+async def generate_handle():
     """
     Generates a non-deterministic random handle
 
     GET request with no body
     returns a handle
     """
-
-    hruuid = HRID(hridfmt=("adjective", "noun"))
-    handle = hruuid.generate()
-    return handle
+    return handle_generator.generate()
 
 
-@app.post("/changehandle")
-async def changehandle(r: Handle, api_key: str = Security(get_api_key)):
+@app.post("/changehandle", response_model=BadgeState)
+async def changehandle(r: Handle, j: dict = Depends(get_badge)):
     """
     Changes the handle for the badge to the new handle
 
     POST request with json body: {"myUUID": "uuid", "handle": "handle"}
     returns full json structure for player
     """
-    j = await client.json.get(r.myUUID, ".")
-
-    if not j:
-        raise HTTPException(status_code=404, detail="Badge not found")
-
     if not r.handle:
         raise HTTPException(status_code=400, detail="New handle missing")
     elif not re.match("^[a-zA-Z0-9_-]*$", r.handle):
@@ -234,353 +1330,452 @@ async def changehandle(r: Handle, api_key: str = Security(get_api_key)):
             status_code=400, detail="Handle too long, max 20 characters"
         )
 
-    if isinstance(j, dict) and "token" in j and "badgeHandle" in j:
-        if not j["token"] == api_key:
-            raise HTTPException(status_code=404, detail="Badge not found")
-
+    if "badgeHandle" in j:
         j["badgeHandle"] = r.handle
-        await client.json.set(r.myUUID, ".", j)
-        return j
+        await update_badge(r.myUUID, j, {"$.badgeHandle": r.handle})
+        return OrjsonResponse(j)
     else:
         raise HTTPException(status_code=500, detail="changehandle - Data error")
 
 
-@app.post("/introcomplete")
-async def introcomplete(r: OnlyUUID, api_key: str = Security(get_api_key)):
+@app.post("/introcomplete", response_model=BadgeState)
+async def introcomplete(r: OnlyUUID, j: dict = Depends(get_badge)):
     """
     POST Request with json body: {"myUUID": "uuid"}
     returns full json structure for player.
     """
-    # use badge_id to lookup json from redis
-    # if there's a result, return the json structure
-    # check if badge_id exists in redis
-    j = await client.json.get(r.myUUID, ".")
-
-    if not j:
-        raise HTTPException(status_code=404, detail="Badge not found")
-
-    if isinstance(j, dict) and "token" in j:
-        if not j["token"] == api_key:
-            raise HTTPException(status_code=404, detail="Badge not found")
-
-    if isinstance(j, dict) and "intro" in j:
+    if "intro" in j:
         j["intro"]["complete"] = 1
     else:
         raise HTTPException(status_code=500, detail="introcomplete - Data error")
 
-    if isinstance(j, dict) and "current_challenge" in j:
+    if "current_challenge" in j:
         j["current_challenge"] = "challenge1"
     else:
         raise HTTPException(status_code=500, detail="introcomplete - Data error")
 
-    await client.json.set(r.myUUID, ".", j)
-    return j
+    await update_badge(
+        r.myUUID, j, {"$.intro.complete": 1, "$.current_challenge": "challenge1"}
+    )
+    return OrjsonResponse(j)
 
 
-@app.post("/register")
+@app.post("/register", response_model=BadgeState)
 async def register(r: Register):
     """
     POST request with json body: {"myUUID": "uuid", "key": "key", "handle": "handle"}
+    handle and token are optional, a badge registering without a handle is
+    given a generated one so it only needs this one request.
     returns full json structure for player
     """
 
-    # create a new badge in redis from the templateJSON string
+    # create a new badge in redis from badge_template
 
     if r.key != registration_key:
         raise HTTPException(status_code=400, detail="Invalid registration key")
 
     # see if the badge_id exists in redis already
     if not await validBadge(r.myUUID):
-        new_token = secrets.token_urlsafe(16)
-
-        j = json.loads(templateJSON)
+        j = new_badge()
 
         if check_intro_started():
             j["intro"]["enabled"] = 1
 
-        # get a new IRID
-        irid = ""
-        while True:
-            irid = random.getrandbits(16)
-            # if the irid doesn't exist in redis, then use it
-            if not await client.json.get(f"{irid}", "."):
-                # update the player in redis with the IR_ID
-                j["IR_ID"] = irid
-                # create a redis key IR_ID with the value: uuid
-                await client.set(f"{irid}", r.myUUID)
-                break
-        if irid == "":
+        # get a new IRID from the pool of unused ones
+        irid = await client.spop(IRID_POOL)
+        if irid is None:
             raise HTTPException(status_code=500, detail="Unable to create IRID")
+        irid = int(irid)
 
-        j["badgeHandle"] = r.handle
+        j["badgeHandle"] = r.handle or handle_generator.generate()
         j["IR_ID"] = irid
 
-        # get the list of apikeys from redis
-        apikeys = await client.lrange("badge_apikeys", 0, -1)
-
-        # if we have r.token and it's in redis, then don't write it.
-        if r.token:
-            if r.token.encode() in apikeys:
-                j["token"] = r.token
-                await client.json.set(f"{r.myUUID}", ".", j)
-                return j
-
-        if new_token.encode() in apikeys:
-            raise HTTPException(status_code=500, detail="Duplicate token error")
+        # keep r.token if it's free for this badge, otherwise issue a new one
+        if r.token and await reuse_token(keys=[token_key(r.token)], args=[r.myUUID]):
+            token = r.token
         else:
-            await client.rpush("badge_apikeys", [new_token])
-            # write state to the database
-            j["token"] = new_token
-
-        await client.json.set(f"{r.myUUID}", ".", j)
+            token = secrets.token_urlsafe(16)
+            # SET NX only claims the token if no other badge has it
+            if not await client.set(token_key(token), r.myUUID, condition=PureToken.NX):
+                await client.sadd(IRID_POOL, [irid])
+                raise HTTPException(status_code=500, detail="Duplicate token error")
+        j["token"] = token
+
+        # the IR_ID and token keys (with the value: uuid), the badge and its
+        # registration are written together
+        async with await client.pipeline(transaction=True) as pipe:
+            await pipe.set(irid_key(irid), r.myUUID)
+            await pipe.set(token_key(token), r.myUUID)
+            await pipe.json.set(badge_key(r.myUUID), ".", j)
+            await pipe.sadd(BADGES, [r.myUUID])
+            await pipe.execute()
 
         # return current state
-        return j
+        return OrjsonResponse(j)
 
     else:
         raise HTTPException(status_code=208, detail="Badge already exists")
 
 
-@app.post("/checkin")
-async def checkIn(r: OnlyUUID, api_key: str = Security(get_api_key)):
+@app.post("/checkin", response_model=BadgeState)
+async def checkIn(request: Request, r: OnlyUUID, j: dict = Depends(get_badge)):
     """
     POST request with json body: {"myUUID": "uuid"}
     returns full json structure for player
+
+    The response carries the badge's state_version as its ETag, send it back
+    in If-None-Match to get an empty 304 when nothing has changed.
     """
-    # use badge_id to lookup json from redis
-    # if there's a result, return the json structure
-    # check if badge_id exists in redis
-    j = await client.json.get(r.myUUID, ".")
+    if check_intro_started():
+        if "intro" in j:
+            if not j["intro"]["enabled"]:
+                j["intro"]["enabled"] = 1
+                await update_badge(r.myUUID, j, {"$.intro.enabled": 1})
+        else:
+            raise HTTPException(
+                status_code=500, detail="Unable to checkin - Data error"
+            )
 
-    if not j:
-        raise HTTPException(status_code=404, detail="Badge not found")
+    etag = state_etag(j)
+    if not etag:
+        return OrjsonResponse(j)
 
-    if isinstance(j, dict) and "token" in j:
-        if not j["token"] == api_key:
-            raise HTTPException(status_code=404, detail="Authentication Failed.")
-        else:
-            if check_intro_started():
-                if isinstance(j, dict) and "intro" in j:
-                    j["intro"]["enabled"] = 1
-                    return j
-                else:
-                    raise HTTPException(
-                        status_code=500, detail="Unable to checkin - Data error"
-                    )
-            else:
-                return j
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return OrjsonResponse(j, headers={"ETag": etag})
 
 
 @app.post("/deletebadge")
-async def deletebadge(r: Register, api_key: str = Security(get_api_key)):
+async def deletebadge(r: DeleteBadge, j: dict = Depends(get_badge)):
     """
     POST request with json body: {"myUUID": "uuid", "key": "key"}
     returns "deleted" if successful
     """
-    j = await client.json.get(r.myUUID, ".")
+    if r.key == "THISWILLDELETEBADGE":
+        if "IR_ID" in j:
+            await release_irid(client, j["IR_ID"])
+            # the token stops working, but stays reserved so the badge can
+            # register again with it
+            await client.set(token_key(j["token"]), "")
+            await client.srem(BADGES, [r.myUUID])
+            await client.zrem(LEADERBOARD, [r.myUUID])
+            await client.publish(LEADERBOARD_CHANNEL, r.myUUID)
+            # friends keep the badge in their sets, like in their matches
+            await client.delete([friends_key(r.myUUID)])
+            await client.json.delete(badge_key(r.myUUID), ".")
+            return "deleted"
+        else:
+            raise HTTPException(
+                status_code=500, detail="Unable to delete badge - Data error"
+            )
 
-    if not j:
-        raise HTTPException(status_code=404, detail="Badge not found")
 
-    if isinstance(j, dict) and "token" in j:
-        if not j["token"] == api_key:
-            raise HTTPException(status_code=404, detail="Badge not found")
+def find_hidden_object(j, objectid):
+    """
+    Marks a hidden object as found in j.  Whether that completes challenge2
+    is decided in redis by queue_progress.
 
-        else:
-            if r.key == "THISWILLDELETEBADGE":
-                if isinstance(j, dict) and "IR_ID" in j:
-                    await client.delete(j["IR_ID"])
-                    await client.json.delete(r.myUUID)
-                    return "deleted"
-                else:
-                    raise HTTPException(
-                        status_code=500, detail="Unable to delete badge - Data error"
-                    )
-    else:
-        raise HTTPException(
-            status_code=500, detail="Unable to delete badge - Data error"
-        )
+    returns the changes to write with update_badge
+    """
+    changes = {}
 
+    if objectid:
+        if objectid not in hiddenobjects:
+            raise HTTPException(status_code=404, detail="Object not found")
 
-@app.post("/hiddenobject")
-@limiter.limit("10/minute")
-async def hiddenobject(
-    request: Request, r: UUID_ObjectID, api_key: str = Security(get_api_key)
-):
-    j = await client.json.get(r.myUUID)
+        i = hiddenobjects.index(objectid)
+        if j["challenge2"]["status"][i] == 1:
+            raise HTTPException(status_code=208, detail=f"Uber{i + 1} Already found")
 
-    if not j:
-        raise HTTPException(status_code=404, detail="Badge not found")
+    if j["current_challenge"] != "challenge2":
+        raise HTTPException(status_code=400, detail="Challenge not started")
+
+    if objectid:
+        j["challenge2"]["status"][i] = 1
+        changes[f"$.challenge2.status[{i}]"] = 1
+
+    return changes
 
-    if isinstance(j, dict) and "token" in j:
-        if not j["token"] == api_key:
-            raise HTTPException(status_code=404, detail="Badge not found")
-
-        if r.objectid:
-            if r.objectid == uber1uuid:
-                if j["challenge2"]["status"][0] == 1:
-                    raise HTTPException(status_code=208, detail="Uber1 Already found")
-                j["challenge2"]["status"][0] = 1
-            elif r.objectid == uber2uuid:
-                if j["challenge2"]["status"][1] == 1:
-                    raise HTTPException(status_code=208, detail="Uber2 Already found")
-                j["challenge2"]["status"][1] = 1
-            elif r.objectid == uber3uuid:
-                if j["challenge2"]["status"][2] == 1:
-                    raise HTTPException(status_code=208, detail="Uber3 Already found")
-                j["challenge2"]["status"][2] = 1
-            elif r.objectid == uber4uuid:
-                if j["challenge2"]["status"][3] == 1:
-                    raise HTTPException(status_code=208, detail="Uber4 Already found")
-                j["challenge2"]["status"][3] = 1
-            elif r.objectid == uber5uuid:
-                if j["challenge2"]["status"][4] == 1:
-                    raise HTTPException(status_code=208, detail="Uber5 Already found")
-                j["challenge2"]["status"][4] = 1
-            else:
-                raise HTTPException(status_code=404, detail="Object not found")
 
-        # is challenge 2 complete?
-        if j["current_challenge"] == "challenge2":
-            if j["challenge2"]["status"] == [1, 1, 1, 1, 1]:
-                j["challenge2"]["complete"] = 1
-                j["current_challenge"] = "challenge3"
+def see_monkey(j, monkeyid):
+    """
+    Records an interaction with a monkey in j.  Whether that completes
+    challenge3 is decided in redis by queue_progress.
+
+    returns the changes to write with update_badge
+    """
+    changes = {}
+
+    if monkeyid:
+        if monkeyid == monkeys["cansuuid"]:
+            if j["challenge3"]["interact_cans"] == 1:
+                raise HTTPException(status_code=208, detail="Cans Already interacted")
+            field = "interact_cans"
+        elif monkeyid == monkeys["micuuid"]:
+            if j["challenge3"]["interact_mic"] == 1:
+                raise HTTPException(status_code=208, detail="Mic Already interacted")
+            field = "interact_mic"
+        elif monkeyid == monkeys["shadesuuid"]:
+            if j["challenge3"]["interact_shades"] == 1:
+                raise HTTPException(status_code=208, detail="Shades Already interacted")
+            field = "interact_shades"
         else:
-            raise HTTPException(status_code=400, detail="Challenge not started")
+            raise HTTPException(status_code=404, detail="Unknown Monkey")
 
-    await client.json.set(r.myUUID, ".", j)
-    return j
+        j["challenge3"][field] = 1
+        changes[f"$.challenge3.{field}"] = 1
 
+    return changes
 
-@app.post("/monkeysee")
-@limiter.limit("10/minute")
-async def monkeysee(
-    request: Request, r: UUID_ObjectID, api_key: str = Security(get_api_key)
-):
-    j = await client.json.get(r.myUUID)
 
-    if not j:
-        raise HTTPException(status_code=404, detail="Badge not found")
+async def queue_progress(pipe, badge_id, j, changes):
+    """
+    Queues the changes from find_hidden_object or see_monkey followed by
+    COMPLETE_CHALLENGES_LUA, which moves the badge on if they finished its
+    challenge.  Follow it with a JSON.GET of the badge, j can't tell whether
+    it did.
+    """
+    if changes:
+        await queue_badge_update(pipe, badge_id, j, changes)
+    await complete_challenges(
+        keys=[badge_key(badge_id), friends_key(badge_id), LEADERBOARD],
+        args=[badge_id, LEADERBOARD_CHANNEL],
+        client=pipe,
+    )
 
-    if isinstance(j, dict) and "token" in j:
-        if not j["token"] == api_key:
-            raise HTTPException(status_code=404, detail="Badge not found")
-
-        if r.objectid:
-            if r.objectid == monkeys["cansuuid"]:
-                if j["challenge3"]["interact_cans"] == 1:
-                    raise HTTPException(
-                        status_code=208, detail="Cans Already interacted"
-                    )
-
-                j["challenge3"]["interact_cans"] = 1
-            elif r.objectid == monkeys["micuuid"]:
-                if j["challenge3"]["interact_mic"] == 1:
-                    raise HTTPException(
-                        status_code=208, detail="Mic Already interacted"
-                    )
-                j["challenge3"]["interact_mic"] = 1
-            elif r.objectid == monkeys["shadesuuid"]:
-                if j["challenge3"]["interact_shades"] == 1:
-                    raise HTTPException(
-                        status_code=208, detail="Shades Already interacted"
-                    )
-                j["challenge3"]["interact_shades"] = 1
-            else:
-                raise HTTPException(status_code=404, detail="Unknown Monkey")
-
-        # is challenge 3 complete?
-        if j["current_challenge"] == "challenge3":
-            # have I seen all the monkeys?
-            if (
-                j["challenge3"]["interact_cans"] == 1
-                and j["challenge3"]["interact_mic"] == 1
-                and j["challenge3"]["interact_shades"] == 1
-            ):
-                j["challenge3"]["complete"] = 1
-                j["current_challenge"] = "winner"
 
-    await client.json.set(r.myUUID, ".", j)
-    return j
+async def save_progress(badge_id, j, changes):
+    """
+    Runs queue_progress in one MULTI/EXEC
 
+    returns the badge's json structure as stored
+    """
+    async with await client.pipeline(transaction=True) as pipe:
+        await queue_progress(pipe, badge_id, j, changes)
+        await pipe.json.get(badge_key(badge_id), ".")
+        replies = await pipe.execute()
+    return replies[-1]
 
-@app.post("/friendrequest")
-async def friendrequest(r: UUID_IRID, api_key: str = Security(get_api_key)):
+
+def check_pairing(j, remote_irid):
+    """
+    Rejects friend requests that can never succeed before touching redis
+    """
+    if "IR_ID" in j:
+        if str(j["IR_ID"]) == remote_irid:
+            raise HTTPException(status_code=400, detail="Cannot pair with yourself")
+    else:
+        raise HTTPException(status_code=500, detail="Data error")
+
+    # IR_IDs are numbers, anything else can't be a badge
+    if not remote_irid.isdigit():
+        raise HTTPException(status_code=404, detail="Remote IRID not found")
+
+
+# status codes for the results of PAIR_BADGES_LUA
+pairing_status = {
+    "paired": (200, None),
+    "friends": (208, "Already friends"),
+    "missing": (404, "Remote Badge not found"),
+}
+
+
+@app.post(
+    "/hiddenobject",
+    response_model=BadgeState,
+    dependencies=[Depends(idempotent), Depends(RateLimit("hiddenobject", 10))],
+)
+async def hiddenobject(r: UUID_ObjectID, j: dict = Depends(get_badge)):
+    changes = find_hidden_object(j, r.objectid)
+    return OrjsonResponse(await save_progress(r.myUUID, j, changes))
+
+
+@app.post(
+    "/monkeysee",
+    response_model=BadgeState,
+    dependencies=[Depends(idempotent), Depends(RateLimit("monkeysee", 10))],
+)
+async def monkeysee(r: UUID_ObjectID, j: dict = Depends(get_badge)):
+    changes = see_monkey(j, r.objectid)
+    return OrjsonResponse(await save_progress(r.myUUID, j, changes))
+
+
+@app.post(
+    "/friendrequest", response_model=BadgeState, dependencies=[Depends(idempotent)]
+)
+async def friendrequest(r: UUID_IRID, myjson: dict = Depends(get_badge)):
     """
     Creates a match with another badge
-    Adds the match to the player's json['challenge1']['matches'] list as a string
-    with the format of "handle:uuid".  this can be processed by client to
-    display the handle.
+    Adds each badge to the other's friend set, and the match to both
+    players' json['challenge1']['matches'] dicts keyed by the other badge's
+    IR_ID with the value {"handle": ..., "uuid": ...}.
+    The pairing runs as a single lua script so concurrent pairings can't
+    overwrite each other's matches.
 
     POST request with json body:{ myUUID: "uuid", remoteIRID: "irid" }
     returns full json structure for player
     """
-    myjson = await client.json.get(r.myUUID)
+    check_pairing(myjson, r.remoteIRID)
 
-    if not myjson:
-        raise HTTPException(status_code=404, detail="Badge not found")
+    # get the uuid from the irid
+    remote_uuid = await client.get(irid_key(r.remoteIRID))
+    if not remote_uuid:
+        raise HTTPException(status_code=404, detail="Remote IRID not found")
+    remote_uuid = remote_uuid.decode()
+
+    result = await pair_badges(
+        keys=[
+            badge_key(r.myUUID),
+            badge_key(remote_uuid),
+            friends_key(r.myUUID),
+            friends_key(remote_uuid),
+            LEADERBOARD,
+        ],
+        args=[r.myUUID, remote_uuid, r.remoteIRID],
+    )
 
-    if isinstance(myjson, dict) and "token" in myjson and "IR_ID" in myjson:
-        if not myjson["token"] == api_key:
-            raise HTTPException(status_code=404, detail="Badge not found")
+    code, detail = pairing_status.get(result[0].decode(), (500, "Data error"))
+    if code != 200:
+        raise HTTPException(status_code=code, detail=detail)
+    await client.publish(LEADERBOARD_CHANNEL, r.myUUID)
+    notify_badge(remote_uuid)
 
-        if str(myjson["IR_ID"]) == r.remoteIRID:
-            raise HTTPException(status_code=400, detail="Cannot pair with yourself")
-    else:
-        raise HTTPException(status_code=500, detail="Data error")
+    # the script returns the document already encoded, pass it straight on
+    return Response(result[1], media_type="application/json")
 
-    # does the irid exist in redis?
-    if await client.get(r.remoteIRID):
-        # get the uuid from the irid
-        remote_uuid = await client.get(r.remoteIRID)
-        if isinstance(remote_uuid, bytes):
-            remote_uuid = remote_uuid.decode()
-        else:
-            raise HTTPException(status_code=500, detail="Error decoding IRID")
-
-        # get the handle from the player's uuid json key
-        remote_json = await client.json.get(remote_uuid, ".")
-
-        if remote_json:
-            if isinstance(myjson, dict) and "challenge1" in myjson:
-                if str(r.remoteIRID) in myjson["challenge1"]["matches"]:
-                    raise HTTPException(status_code=208, detail="Already friends")
-                else:
-                    if isinstance(remote_json, dict) and "badgeHandle" in remote_json:
-                        myjson["challenge1"]["matches"][str(r.remoteIRID)] = {
-                            "handle": remote_json["badgeHandle"],
-                            "uuid": remote_uuid,
-                        }
-
-                        remote_json["challenge1"]["matches"][str(myjson["IR_ID"])] = {
-                            "handle": myjson["badgeHandle"],
-                            "uuid": r.myUUID,
-                        }
-
-                        # is Challenge 1 complete? if so, set current_challenge to challenge2
-                        # and set challenge1 complete to 1
-                        if myjson["current_challenge"] == "challenge1":
-                            if len(myjson["challenge1"]["matches"]) >= 5:
-                                myjson["challenge1"]["complete"] = 1
-                                myjson["current_challenge"] = "challenge2"
-
-                        if remote_json["current_challenge"] == "challenge1":
-                            if len(remote_json["challenge1"]["matches"]) >= 5:
-                                remote_json["challenge1"]["complete"] = 1
-                                remote_json["current_challenge"] = "challenge2"
-
-                        await client.json.set(remote_uuid, ".", remote_json)
-                        await client.json.set(r.myUUID, ".", myjson)
-                        return myjson
-                    else:
-                        raise HTTPException(status_code=500, detail="Data error")
+
+@app.post("/batch", dependencies=[Depends(idempotent), Depends(RateLimit("batch", 10))])
+async def batch(r: Batch, j: dict = Depends(get_badge)):
+    """
+    Applies a list of friendrequest, hiddenobject and monkeysee operations
+    for one badge in a single redis transaction.  Operations are checked in
+    order, but pairings only run when the transaction executes, so a
+    challenge1 completed by a friendrequest doesn't unlock a hiddenobject
+    later in the same batch.  Only one hiddenobject and one monkeysee
+    operation is accepted per batch, to keep the same rate limit as their
+    endpoints.
+
+    POST request with json body:
+    {
+        "myUUID": "uuid",
+        "ops": [
+            {"op": "friendrequest", "remoteIRID": "irid"},
+            {"op": "hiddenobject", "objectid": 12341},
+            {"op": "monkeysee", "objectid": 37634}
+        ]
+    }
+    returns {"results": [{"op": ..., "status": ..., "detail": ...}, ...],
+             "state": full json structure for player}
+    """
+    if len(r.ops) > max_batch_ops:
+        raise HTTPException(
+            status_code=400, detail=f"Too many operations, max {max_batch_ops}"
+        )
+
+    # resolve every remote IRID up front in one round trip
+    irids = [
+        op.remoteIRID
+        for op in r.ops
+        if op.op == "friendrequest" and op.remoteIRID.isdigit()
+    ]
+    remote_uuids = {}
+    if irids:
+        uuids = await client.mget([irid_key(irid) for irid in irids])
+        remote_uuids = {irid: u.decode() for irid, u in zip(irids, uuids) if u}
+
+    results = []
+    changes = {}
+    progress = False
+    pairings = []
+    seen = set()
+    for op in r.ops:
+        result = {"op": op.op, "status": 200, "detail": None}
+        results.append(result)
+        try:
+            if op.op in ("hiddenobject", "monkeysee") and op.op in seen:
+                raise HTTPException(status_code=429, detail="One per batch")
+            seen.add(op.op)
+
+            if op.op == "hiddenobject":
+                changes.update(find_hidden_object(j, op.objectid))
+                progress = True
+            elif op.op == "monkeysee":
+                changes.update(see_monkey(j, op.objectid))
+                progress = True
+            elif op.op == "friendrequest":
+                check_pairing(j, op.remoteIRID)
+                remote_uuid = remote_uuids.get(op.remoteIRID)
+                if not remote_uuid:
+                    raise HTTPException(status_code=404, detail="Remote IRID not found")
+                pairings.append((result, remote_uuid, op.remoteIRID))
             else:
-                raise HTTPException(status_code=500, detail="Data error")
-        else:
-            raise HTTPException(status_code=404, detail="Remote Badge not found")
-    else:
+                raise HTTPException(status_code=400, detail="Unknown operation")
+        except HTTPException as err:
+            result["status"] = err.status_code
+            result["detail"] = err.detail
+
+    async with await client.pipeline(transaction=True) as pipe:
+        if progress:
+            await queue_progress(pipe, r.myUUID, j, changes)
+        if pairings:
+            await pipe.publish(LEADERBOARD_CHANNEL, r.myUUID)
+        for _, remote_uuid, remote_irid in pairings:
+            await pair_badges(
+                keys=[
+                    badge_key(r.myUUID),
+                    badge_key(remote_uuid),
+                    friends_key(r.myUUID),
+                    friends_key(remote_uuid),
+                    LEADERBOARD,
+                ],
+                args=[r.myUUID, remote_uuid, remote_irid],
+                client=pipe,
+            )
+        await pipe.json.get(badge_key(r.myUUID), ".")
+        replies = await pipe.execute()
+
+    pairing_replies = replies[-1 - len(pairings) : -1]
+    for (result, remote_uuid, _), reply in zip(pairings, pairing_replies):
+        code, detail = pairing_status.get(reply[0].decode(), (500, "Data error"))
+        result["status"] = code
+        result["detail"] = detail
+        if code == 200:
+            notify_badge(remote_uuid)
+
+    return OrjsonResponse({"results": results, "state": replies[-1]})
+
+
+@app.post("/frienddegree")
+async def frienddegree(r: OnlyUUID, j: dict = Depends(get_badge)):
+    """
+    POST request with json body: {"myUUID": "uuid"}
+    returns {"degree": n}, the number of badges this badge has paired with
+    """
+    return {"degree": await client.scard(friends_key(r.myUUID))}
+
+
+@app.post("/mutualfriends")
+async def mutualfriends(r: UUID_IRID, j: dict = Depends(get_badge)):
+    """
+    Friends this badge has in common with another badge
+
+    POST request with json body: {"myUUID": "uuid", "remoteIRID": "irid"}
+    returns {"count": n, "handles": [...]}, the handles sorted
+    """
+    remote_uuid = await client.get(irid_key(r.remoteIRID))
+    if not remote_uuid:
         raise HTTPException(status_code=404, detail="Remote IRID not found")
 
+    mutual = await client.sinter(
+        [friends_key(r.myUUID), friends_key(remote_uuid.decode())]
+    )
+    # deleted badges stay in their friends' sets, leave them out
+    handles = []
+    if mutual:
+        keys = [badge_key(m.decode()) for m in mutual]
+        handles = [h for h in await client.json.mget(keys, ".badgeHandle") if h]
+    return {"count": len(handles), "handles": sorted(handles)}
+
 
 # ADMIN Requests
 
@@ -593,15 +1788,91 @@ async def startintro(r: Admin):
     returns 404 if key is invalid
     """
     if r.key == ADMINKEY:
-        f = open("intro_started", "w")
-        f.write("intro started")
-        f.close()
+        await set_game_phase(client, intro_started=True)
+        notify(MQTT_BROADCAST_TOPIC, {"event": "game_phase"})
         return "intro started"
     else:
         raise HTTPException(status_code=404)
 
 
-@app.post("/monkeymode")
+@app.get("/leaderboard")
+async def leaderboard(offset: int = 0, limit: int = 20, uuid: str = ""):
+    """
+    GET request with optional offset and limit (max 100) query parameters
+    returns {"total": n, "entries": [{"rank", "handle", "score"}, ...]}, best
+    score first.  With a uuid query parameter the badge's own "rank" and
+    "score" are included, both null if it isn't on the leaderboard yet.
+    """
+    if offset < 0 or not 0 < limit <= max_leaderboard_limit:
+        raise HTTPException(status_code=400, detail="Invalid offset or limit")
+
+    async with await client.pipeline(transaction=False) as pipe:
+        await pipe.zcard(LEADERBOARD)
+        await pipe.zrevrange(LEADERBOARD, offset, offset + limit - 1, withscores=True)
+        if uuid:
+            await pipe.zrevrank(LEADERBOARD, uuid)
+            await pipe.zscore(LEADERBOARD, uuid)
+        replies = await pipe.execute()
+
+    total, top = replies[0], replies[1]
+    keys = [badge_key(m.member.decode()) for m in top]
+    handles = await client.json.mget(keys, ".badgeHandle") if top else []
+
+    result = {
+        "total": total,
+        "entries": [
+            {"rank": offset + i + 1, "handle": handle, "score": int(m.score)}
+            for i, (m, handle) in enumerate(zip(top, handles))
+        ],
+    }
+    if uuid:
+        rank, score = replies[2], replies[3]
+        result["rank"] = rank + 1 if rank is not None else None
+        result["score"] = int(score) if score is not None else None
+
+    return OrjsonResponse(result)
+
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness check for load balancers, a worker only serves requests once
+    its startup has finished
+    returns "ready" if redis is reachable, 503 if it isn't
+    """
+    try:
+        await client.ping()
+    except Exception:
+        raise HTTPException(status_code=503, detail="Redis unavailable")
+    return "ready"
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Request and redis metrics in the prometheus text format
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.post("/irid_pool")
+async def irid_pool(r: Admin):
+    """
+    POST request with ADMINKEY
+    returns the number of IR_IDs left for new badges
+    """
+    if r.key != ADMINKEY:
+        raise HTTPException(status_code=404)
+
+    return {"remaining": await client.scard(IRID_POOL)}
+
+
+@app.post("/monkeymode", response_model=BadgeState)
 async def monkeymode(r: MonkeyMode):
     """
     POST request with ADMINKEY
@@ -620,7 +1891,7 @@ async def monkeymode(r: MonkeyMode):
         print("status is missing")
         raise HTTPException(status_code=404)
 
-    j = await client.json.get(r.uuid, ".")
+    j = await client.json.get(badge_key(r.uuid), ".")
 
     if not j or not r.key:
         print("badge not found")
@@ -629,14 +1900,12 @@ async def monkeymode(r: MonkeyMode):
     if isinstance(j, dict):
         if r.status == "on":
             j["monkey_id"] = r.objectid
+            await update_badge(r.uuid, j, {"$.monkey_id": r.objectid})
             print(f"Set badge: {r.uuid} to monkey mode: {r.objectid}")
         if r.status == "off":
-            del j["monkey_id"]
-        await client.json.set(r.uuid, ".", j)
-        return j
+            j.pop("monkey_id", None)
+            await update_badge(r.uuid, j, {}, removed=["$.monkey_id"])
+        notify_badge(r.uuid)
+        return OrjsonResponse(j)
     else:
         raise HTTPException(status_code=404)
-
-
-if __name__ == "__main__":
-    uvicorn.run(app, port=8000, host="0.0.0.0")
@@ -0,0 +1,29 @@
+"""
+Starts the api server with uvicorn, run from this directory:
+
+    python serve.py
+
+main.py only defines the app, so each worker imports it once.  Running it
+as a script would define its prometheus metrics as __main__ and again when
+uvicorn imported main:app, which fails with a duplicate timeseries.
+"""
+
+import glob
+import os
+
+import uvicorn
+
+# worker processes to start
+workers = int(os.environ.get("MB_WORKERS", "1"))
+
+
+if __name__ == "__main__":
+    # metrics left over from the last run would be added to this one's
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+            os.remove(path)
+
+    uvicorn.run(
+        "main:app", port=8000, host="0.0.0.0", workers=workers, proxy_headers=True
+    )
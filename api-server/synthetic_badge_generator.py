@@ -42,15 +42,28 @@ templateJSON = """
 
 async def create_api_key(client, badge_id, api_key):
     print(f"{badge_id} {api_key}")
-    apikeys = await client.lrange("badge_apikeys", 0, -1)
 
-    # search l for badge_id in bytes format
-    for i in apikeys:
-        if i.decode() == api_key:
-            return
+    # token -> badge uuid, the badges here all share one token
+    await client.set(f"token:{api_key}", f"{badge_id}")
 
-    # if api_key isn't in apikeys - then add it
-    await client.rpush("badge_apikeys", api_key.split())
+
+async def create_badge(client, badge_id, j):
+    # badge documents are namespaced and listed in the "badges" registry
+    await client.json.set(f"badge:{badge_id}", ".", j)
+    await client.sadd("badges", [badge_id])
+    if j["challenge1"]["matches"]:
+        await client.sadd(f"friends:{badge_id}", j["challenge1"]["matches"])
+    # the scoreboard reads the ranking from the api server's leaderboard
+    if j["intro"]["complete"]:
+        score = len(j["challenge1"]["matches"])
+        for challenge, points in (
+            ("challenge1", 1000),
+            ("challenge2", 2000),
+            ("challenge3", 3000),
+        ):
+            if j[challenge]["complete"]:
+                score += points
+        await client.zadd("leaderboard", {badge_id: score})
 
 
 async def main():
@@ -64,7 +77,7 @@ async def main():
         handle = hruuid.generate()
         j['badgeHandle'] = handle # create random handle
         j['token'] = TESTAPIKEY
-        await client.json.set(f"{uuid}", ".", j)
+        await create_badge(client, uuid, j)
         await create_api_key(client, uuid, TESTAPIKEY)
     """
 
@@ -77,7 +90,7 @@ async def main():
     j["badgeHandle"] = handle  # create random handle
     j["token"] = TESTAPIKEY
     j["intro"]["complete"] = 1
-    await client.json.set(f"badge1", ".", j)
+    await create_badge(client, "badge1", j)
     await create_api_key(client, uuid, TESTAPIKEY)
 
     # Intro and Challenge 1
@@ -89,7 +102,7 @@ async def main():
     j["token"] = TESTAPIKEY
     j["intro"]["complete"] = 1
     j["challenge1"]["complete"] = 1
-    await client.json.set(f"badge2", ".", j)
+    await create_badge(client, "badge2", j)
     await create_api_key(client, uuid, TESTAPIKEY)
 
     # Intro and Challenge 1 and Challenge 2
@@ -103,7 +116,7 @@ async def main():
     j["challenge1"]["complete"] = 1
     j["challenge2"]["complete"] = 1
     j["challenge1"]["matches"] = ["1", "2", "3", "4", "5"]
-    await client.json.set(f"badge3", ".", j)
+    await create_badge(client, "badge3", j)
     await create_api_key(client, uuid, TESTAPIKEY)
 
     # Intro and Challenge 1 and Challenge 2 and matches
@@ -117,7 +130,7 @@ async def main():
     j["challenge1"]["complete"] = 1
     j["challenge2"]["complete"] = 1
     j["challenge1"]["matches"] = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10"]
-    await client.json.set(f"badge4", ".", j)
+    await create_badge(client, "badge4", j)
     await create_api_key(client, uuid, TESTAPIKEY)
 
     uuid = uuid4()
@@ -143,7 +156,7 @@ async def main():
         "10",
         "11",
     ]
-    await client.json.set(f"badge5", ".", j)
+    await create_badge(client, "badge5", j)
     await create_api_key(client, uuid, TESTAPIKEY)
 
 
@@ -6,6 +6,9 @@ nvs = NVS("monkeybadge")
 WIFI_SSID = "HushCon"
 WIFI_PASSWORD = "ThreeAmigos"
 API_SERVER = "https://update.kafka.tel/api"
+# MQTT broker the api server publishes state changes to, empty turns push off
+MQTT_SERVER = ""
+MQTT_PORT = 1883
 
 
 def setNVS(key, value):
@@ -46,6 +49,11 @@ try:
 except Exception:
     pass
 
+try:
+    MQTT_SERVER = getNVS("MQTT_SERVER", 255)
+except Exception:
+    pass
+
 RESET_URL = "https://update.kafka.tel/firmware/reset.json"
 UPDATE_URL = "https://update.kafka.tel/firmware/update.json"
 
@@ -53,6 +61,18 @@ UPDATE_URL = "https://update.kafka.tel/firmware/update.json"
 REG_KEY = "7bc78281-2036-41b2-8d98-fc23ec504e9a"
 MONKEY_PERIOD = 5000
 CHECKIN_PERIOD = 60000
+# while push is connected the server tells us about changes, so only check in
+# occasionally to catch anything that was missed
+CHECKIN_PERIOD_PUSH = 600000
+# spread the fleet's checkins after a broadcast over this many ms
+PUSH_BROADCAST_JITTER = 30000
+MQTT_RETRY_PERIOD = 30000
+MQTT_KEEPALIVE = 120
+# seconds to wait for the broker when connecting, so an unreachable one
+# doesn't stall the main loop
+MQTT_CONNECT_TIMEOUT = 5
+# the server allows 10 batches a minute
+BATCH_PERIOD = 7000
 BUTTON_PINS = [4, 14, 15, 13]
 BUTTON_PIN_DESCRIPTIONS = [
     "left up",
@@ -22,23 +22,11 @@ class GameClient:
 
         request_url = self.baseurl + "/register"
 
-        # get a handle from the server
-        try:
-            r = requests.get(self.baseurl + "/generate_handle")
-        except Exception as err:
-            print(f"Error reaching {self.baseurl}/generate_handle: {err}")
-            return None
-
-        if r.status_code == 200:
-            request_body["handle"] = r.text.strip('"')
-        else:
-            request_body["handle"] = "unnamed_monkey"
-
-        r.close()
-
         # print(f"connecting to {request_url}")
         # print(f"Sending JSON Values: {request_body}")
 
+        # the server generates a handle when the badge doesn't have one yet,
+        # so registering is a single request
         try:
             r = requests.post(request_url, headers=self.headers, json=request_body)
         except Exception as err:
@@ -54,20 +42,29 @@ class GameClient:
             r.close()
             return None
 
-    def checkin(self, apitoken, uuid):
+    def checkin(self, apitoken, uuid, state_version=None):
         """
         Checkin with the MonkeyBadge server API
+
+        If state_version is given the server answers 304 with no body when
+        the badge's state hasn't changed since that version.
         """
 
         request_url = self.baseurl + "/checkin"
 
         request_body = {"myUUID": uuid}
 
-        sc, j = self.secure_api_request(request_url, apitoken, request_body)
+        headers = None
+        if state_version is not None:
+            headers = {"If-None-Match": f'"{state_version}"'}
+
+        sc, j = self.secure_api_request(request_url, apitoken, request_body, headers)
 
         print(f"Checkin returned {sc}, {j}")
         if sc == 404:
             return 404, None
+        elif sc == 304:
+            return 304, None
         elif sc == 200:
             return 200, j
 
@@ -135,12 +132,30 @@ class GameClient:
             print(f"error already interacted with {monkeyid}")
         return sc, None
 
-    def secure_api_request(self, url, token, json):
+    def batch(self, token, uuid, ops, key=None):
+        """
+        Send queued operations to /batch.  Retries of the same batch should
+        pass the same key, so the server replays its result if an earlier
+        attempt went through.
+        """
+        request_url = self.baseurl + "/batch"
+        request_body = {"myUUID": uuid, "ops": ops}
+        headers = {"Idempotency-Key": key} if key else None
+
+        sc, j = self.secure_api_request(request_url, token, request_body, headers)
+        print(f"batch returned {sc}, {j}")
+        if sc == 200:
+            return sc, j
+        return sc, None
+
+    def secure_api_request(self, url, token, json, headers=None):
         """
         Send a request to the MonkeyBadge server API
         """
 
         header = self.headers | {"X-API-Key": token}
+        if headers:
+            header = header | headers
         print(f"API Call to {url}")
         print(f"header: {header}\n body: {json}")
 
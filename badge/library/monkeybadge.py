@@ -1,6 +1,7 @@
 from machine import ADC
 import micropython
 import network
+import random
 import time
 import _thread
 
@@ -15,6 +16,7 @@ from library.gameclient import GameClient
 from library.battery import Meter
 from library.leds import LEDHandler
 from library.menu import Menu, MenuItem
+from library.push import PushClient
 from library.radio import SI470X
 from library.cli import CLI
 import library.wifi as wifi
@@ -54,6 +56,14 @@ class MonkeyBadge:
         # anything in the calls queue should return true on success and false
         # on failure
         self._calls_queue = dict()
+        # friend, hidden object and monkey calls are sent together to /batch,
+        # keyed like the calls queue and holding the op for each call
+        self._batch_queue = dict()
+        self.last_batch = 0
+        # names and Idempotency-Key of the last batch that didn't get an
+        # answer, a retry of the same calls reuses the key
+        self._batch_names = None
+        self._batch_key = None
 
         # radio init
         self.radio = SI470X()
@@ -105,6 +115,8 @@ class MonkeyBadge:
         self.lock_radio_station = False
         self.handle = ""
         self.current_challenge = None
+        # version of the saved gamestate, lets checkin skip unchanged state
+        self.state_version = None
         self.challenge1 = {}
         self.challenge2 = {}
         self.challenge3 = {}
@@ -114,6 +126,9 @@ class MonkeyBadge:
         self.badge_uuid = re.sub(":", "-", str(wifi.get_mac(self.wlan)))
         print("Badge UUID: %s" % (self.badge_uuid))
 
+        # server push, lets the badge check in less often while connected
+        self.push = PushClient(self.badge_uuid)
+
         print("Confirming firmware boot success. Cancelling OTA Rollback")
         OTARollback.cancel()
 
@@ -422,6 +437,7 @@ class MonkeyBadge:
         print("Erasing Non Volatile Storage (NVS)...")
         try:
             config.eraseNVS("API_SERVER")
+            config.eraseNVS("MQTT_SERVER")
             config.eraseNVS("WIFI_SSID")
             config.eraseNVS("WIFI_PASSWORD")
         except Exception:
@@ -640,6 +656,7 @@ class MonkeyBadge:
                         ]
                     )
 
+            self.state_version = j.get("state_version")
             self.challenge1 = j["challenge1"]
             self.friends = j["challenge1"]["matches"]
             self.challenge2 = j["challenge2"]
@@ -692,38 +709,52 @@ class MonkeyBadge:
                 del self.seen_badges[badge]
 
     @if_wifi
-    def friendrequest(self, irid):
-        r = self.gameclient.friendrequest(self.apitoken, self.badge_uuid, irid)
-        print(f"friend request with {irid}")
-        if r:
-            self.save_gamestate(r)
-            return True
-        print(f"friend request failed: {r}")
-        return False
+    def flush_batch(self):
+        """
+        Send the queued friend, hidden object and monkey calls in one request.
+        Hidden objects and monkeys wait in the queue until their challenge
+        starts, and the server takes one of each per batch.
+        """
+        names = []
+        ops = []
+        for name, op in self._batch_queue.items():
+            if op["op"] == "hiddenobject" and self.current_challenge != "challenge2":
+                continue
+            if op["op"] == "monkeysee" and self.current_challenge != "challenge3":
+                continue
+            if op["op"] != "friendrequest" and op["op"] in [o["op"] for o in ops]:
+                continue
+            names.append(name)
+            ops.append(op)
+
+        if not ops:
+            return
 
-    @if_wifi
-    def hiddenobjectrequest(self, sender):
-        if self.current_challenge == "challenge2":
-            sc, j = self.gameclient.hiddenobject(self.apitoken, self.badge_uuid, sender)
-            if j and sc == 200:
-                self.save_gamestate(j)
-                self.load_gamestate(j)
-            if sc == 208:
-                print(f"Already seen object {j}.")
-            else:
-                print("failed to pair with hidden object")
+        if names != self._batch_names:
+            self._batch_names = names
+            self._batch_key = "%08x%08x" % (
+                random.getrandbits(32),
+                random.getrandbits(32),
+            )
 
-    @if_wifi
-    def monkeyseerequest(self, sender):
-        if self.current_challenge == "challenge3":
-            sc, j = self.gameclient.monkeysee(self.apitoken, self.badge_uuid, sender)
-            if j and sc == 200:
-                self.save_gamestate(j)
-                self.load_gamestate(j)
-            if sc == 208:
-                print(f"Already seen monkey {j}.")
-            else:
-                print(f"failed to pair with monkey badge: {sc}")
+        sc, j = self.gameclient.batch(
+            self.apitoken, self.badge_uuid, ops, self._batch_key
+        )
+        if sc != 200 or not j:
+            print(f"batch failed: {sc}")
+            return
+        # answered, so calls left in the queue get a fresh key next time
+        self._batch_names = None
+
+        for name, result in zip(names, j["results"]):
+            # anything else is retried with the next batch
+            if result["status"] in (200, 208, 400, 404):
+                del self._batch_queue[name]
+            if result["status"] != 200:
+                print(f"{name} failed: {result['status']} {result['detail']}")
+
+        self.save_gamestate(j["state"])
+        self.load_gamestate(j["state"])
 
     @if_wifi
     def config_konami_win(self):
@@ -744,11 +775,15 @@ class MonkeyBadge:
             self.register()
         else:
             print("checking in badge")
-            sc, r = self.gameclient.checkin(self.apitoken, self.badge_uuid)
+            sc, r = self.gameclient.checkin(
+                self.apitoken, self.badge_uuid, self.state_version
+            )
             if sc == 200 and r:
                 self.save_gamestate(r)
                 self.load_gamestate()
                 print("Badge successfully checked in")
+            elif sc == 304:
+                print("Badge successfully checked in, gamestate unchanged")
             elif sc == 404:
                 # badge doesn't exist on the server, but the API token does.
                 # This means the server was reset, and we need to re-register.
@@ -758,6 +793,28 @@ class MonkeyBadge:
                 print(f"Badge checkin failed server returned: {sc}")
         # time.sleep_ms(config.CHECKIN_PERIOD * 1000)
 
+    def checkin_period(self):
+        """Poll slowly while the server can push changes to us"""
+        if self.push.connected:
+            return config.CHECKIN_PERIOD_PUSH
+        return config.CHECKIN_PERIOD
+
+    def schedule_checkin(self, now, delay=0):
+        """Bring the next checkin forward to `delay` ms from now"""
+        period = self.checkin_period()
+        due = time.ticks_add(self.last_checkin, period)
+        if time.ticks_diff(due, now) > delay:
+            self.last_checkin = time.ticks_add(now, delay - period)
+
+    def push_check(self, now):
+        """Check in when the server says our state or the game phase changed"""
+        heard = self.push.poll(now)
+        if "badge" in heard:
+            self.schedule_checkin(now)
+        elif "broadcast" in heard:
+            # the whole fleet hears broadcasts, don't all check in at once
+            self.schedule_checkin(now, random.randint(0, config.PUSH_BROADCAST_JITTER))
+
     @if_ir
     def infrared_check(self):
         now = time.ticks_ms()
@@ -780,10 +837,10 @@ class MonkeyBadge:
                     print(f"init pair: {sender}")
                     self.log = f"PAIR: {sender}"
                     if sender not in self.friends:
-                        self._calls_queue[f"friendrequest_{sender}"] = (
-                            self.friendrequest,
-                            [sender],
-                        )
+                        self._batch_queue[f"friendrequest_{sender}"] = {
+                            "op": "friendrequest",
+                            "remoteIRID": str(sender),
+                        }
                 elif opcode == "EMOTE":
                     emote = extra[0]
                     self.show_timed_message(["", config.EMOTES[emote], f"  -{sender}"])
@@ -792,20 +849,20 @@ class MonkeyBadge:
                 elif opcode == "HIDDEN_OBJECT":
                     # TODO Hidden object handling here
                     # sender is id of badge
-                    self._calls_queue[f"hiddenobjectrequest_{sender}"] = (
-                        self.hiddenobjectrequest,
-                        [sender],
-                    )
+                    self._batch_queue[f"hiddenobjectrequest_{sender}"] = {
+                        "op": "hiddenobject",
+                        "objectid": sender,
+                    }
                     print(f"Found hidden object: {sender}!")
 
                 elif opcode == "MONKEY" and not self.monkey_mode:
                     # TODO Monkey handling here
                     # sender is id of monkey
                     print(f"Found monkey {sender}")
-                    self._calls_queue[f"monkeyseerequest_{sender}"] = (
-                        self.monkeyseerequest,
-                        [sender],
-                    )
+                    self._batch_queue[f"monkeyseerequest_{sender}"] = {
+                        "op": "monkeysee",
+                        "objectid": sender,
+                    }
 
     def initialize_badge(self):
         """Do the whole setup thing dawg"""
@@ -844,6 +901,13 @@ class MonkeyBadge:
                 if success:
                     del self._calls_queue[name]
 
+            if (
+                self._batch_queue
+                and time.ticks_diff(now, self.last_batch) >= config.BATCH_PERIOD
+            ):
+                self.flush_batch()
+                self.last_batch = now
+
             # the badge is waiting to execute the next call
             # print(".", end="")
             # print(f"IP: {self.wlan.ifconfig()[0]}, {self.last_checkin} {now}")
@@ -852,9 +916,10 @@ class MonkeyBadge:
                 self.display.set_wifi_status(None)
             else:
                 self.display.set_wifi_status(int(self.wlan.status("rssi")))
+                self.push_check(now)
 
             # checkin, blocking
-            if time.ticks_diff(now, self.last_checkin) >= config.CHECKIN_PERIOD:
+            if time.ticks_diff(now, self.last_checkin) >= self.checkin_period():
                 try:
                     # print(".")
                     self.checkin()
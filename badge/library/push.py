@@ -0,0 +1,94 @@
+"""
+Push notifications from the MonkeyBadge server over MQTT.  The server
+publishes to the badge's own topic when something else changed its state
+(monkey mode, another badge pairing with it) and to the broadcast topic when
+the game phase changes.  Messages are only a nudge to check in, their payload
+isn't used.
+"""
+import time
+
+from umqtt.simple import MQTTClient, MQTTException
+
+import config
+
+BADGE_TOPIC = "monkeybadge/badge/{}"
+BROADCAST_TOPIC = b"monkeybadge/broadcast"
+
+
+class PushClient:
+    """
+    Keeps the MQTT subscription up from the badge's main loop.  umqtt.robust
+    retries a lost connection in a loop until the broker is back, which would
+    stall the badge, so this uses umqtt.simple and tries to reconnect once
+    every MQTT_RETRY_PERIOD instead.
+    """
+
+    def __init__(self, uuid):
+        self.topic = BADGE_TOPIC.format(uuid).encode()
+        self.client = MQTTClient(
+            f"monkeybadge-{uuid}",
+            config.MQTT_SERVER,
+            port=config.MQTT_PORT,
+            keepalive=config.MQTT_KEEPALIVE,
+        )
+        self.client.set_callback(self._on_message)
+        self.connected = False
+        self.last_attempt = None
+        self.last_ping = 0
+        # "badge" and/or "broadcast", for the topics heard from since the
+        # last poll()
+        self.heard = set()
+
+    def _on_message(self, topic, msg):
+        self.heard.add("broadcast" if topic == BROADCAST_TOPIC else "badge")
+
+    def _connect(self, now):
+        try:
+            self.client.connect(timeout=config.MQTT_CONNECT_TIMEOUT)
+            self.client.subscribe(self.topic)
+            self.client.subscribe(BROADCAST_TOPIC)
+        except (OSError, MQTTException) as err:
+            print(f"push connect to {config.MQTT_SERVER} failed: {err}")
+            self._close()
+            return
+        print(f"push connected to {config.MQTT_SERVER}")
+        self.connected = True
+        self.last_ping = now
+        # anything published while we were away was missed
+        self.heard.add("badge")
+
+    def _close(self):
+        self.connected = False
+        try:
+            self.client.sock.close()
+        except Exception:
+            pass
+
+    def poll(self, now):
+        """
+        Connects, or handles any waiting message without blocking.  Returns
+        the topics heard from since the last call.
+        """
+        if not config.MQTT_SERVER:
+            return set()
+
+        if not self.connected:
+            if (
+                self.last_attempt is None
+                or time.ticks_diff(now, self.last_attempt) >= config.MQTT_RETRY_PERIOD
+            ):
+                self.last_attempt = now
+                self._connect(now)
+        else:
+            try:
+                if time.ticks_diff(now, self.last_ping) >= config.MQTT_KEEPALIVE * 500:
+                    self.client.ping()
+                    self.last_ping = now
+                self.client.check_msg()
+            except (OSError, MQTTException) as err:
+                print(f"push disconnected: {err}")
+                self._close()
+
+        heard = self.heard
+        self.heard = set()
+        return heard
@@ -1,70 +1,305 @@
-import coredis
-from flask import Flask, render_template
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
 import random
-import re
+import secrets
+import time
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
+
+import coredis
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from markupsafe import Markup
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    refresher = asyncio.create_task(refresh_snapshots())
+    yield
+    refresher.cancel()
+    client.connection_pool.disconnect()
+
+
+app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+here = os.path.dirname(os.path.abspath(__file__))
+app.mount("/static", StaticFiles(directory=os.path.join(here, "static")), name="static")
+templates = Jinja2Templates(directory=os.path.join(here, "templates"))
+# paths rather than full urls, the rows are rendered once for every viewer
+templates.env.globals["static_url"] = lambda filename: app.url_path_for(
+    "static", path=filename
+)
+logger = logging.getLogger(__name__)
+
+
+redishost = os.environ.get("MB_REDIS_HOST", "127.0.0.1")
+redisport = int(os.environ.get("MB_REDIS_PORT", "6379"))
+# seconds between snapshot rebuilds: changes published by the api server are
+# picked up after at least the min period, and the board is rebuilt every
+# max period even if nothing was heard
+min_refresh_period = float(os.environ.get("MB_SCOREBOARD_MIN_REFRESH", "1"))
+max_refresh_period = float(os.environ.get("MB_SCOREBOARD_MAX_REFRESH", "30"))
+
+# the api server keeps every badge past the intro in this sorted set, scored
+# one point per friend plus 1000, 2000 and 3000 for the three challenges.
+# The documents are under "badge:<uuid>".
+LEADERBOARD = "leaderboard"
+# published by the api server after anything that can change a row
+LEADERBOARD_CHANNEL = "leaderboard_changed"
+CHALLENGE_POINTS = {"challenge1": 1000, "challenge2": 2000, "challenge3": 3000}
+
+# badges fetched per round trip
+chunk_size = 1000
+# changes kept for live viewers that reconnect, one per snapshot that
+# changed.  Viewers further behind reload the page.
+delta_history = 64
+# seconds between keepalives on an idle live stream
+keepalive_period = 15
+
+# rows are known to viewers by an id derived from the badge uuid, which the
+# api server never shows publicly
+row_id_key = secrets.token_bytes(16)
+
+
+def row_id(uuid):
+    return hashlib.blake2b(uuid, key=row_id_key, digest_size=6).hexdigest()
+
 
-app = Flask(__name__)
+# shared by the refresher for the life of the process, requests never touch
+# redis
+client = coredis.Redis(host=redishost, port=redisport)
 
 
-def is_valid_uuid(mac):
+async def fetch_chunk(ranked):
     """
-    Checks if the given string is a valid MAC address with dashes.
+    The scoreboard rows for a chunk of (uuid, score) leaderboard entries, in
+    one round trip.  Only the handle and challenge flags are read from the
+    documents, a JSON.MGET for each, rather than the whole documents whose
+    match lists are most of their size.
+    """
+    keys = [f"badge:{entry.member.decode()}" for entry in ranked]
+    async with await client.pipeline(transaction=False) as pipe:
+        await pipe.json.mget(keys, ".badgeHandle")
+        for challenge in CHALLENGE_POINTS:
+            await pipe.json.mget(keys, f".{challenge}.complete")
+        handles, *flags = await pipe.execute()
+
+    rows = []
+    for i, entry in enumerate(ranked):
+        # deleted since the leaderboard was read
+        if handles[i] is None:
+            continue
+        row = {
+            "id": row_id(entry.member),
+            "handle": handles[i],
+            "score": int(entry.score),
+        }
+        # what's left of the score once the challenges are taken off is the
+        # match count
+        matches = row["score"]
+        for (challenge, points), complete in zip(CHALLENGE_POINTS.items(), flags):
+            row[challenge] = bool(complete[i])
+            if complete[i]:
+                matches -= points
+        row["matches"] = matches
+        rows.append(row)
+    return rows
+
+
+async def get_redis_data():
+    """every badge past the intro, highest score first"""
+    ranked = await client.zrevrange(LEADERBOARD, 0, -1, withscores=True)
+    result = []
+    for i in range(0, len(ranked), chunk_size):
+        result += await fetch_chunk(ranked[i : i + chunk_size])
+    return result
+
+
+class Snapshot:
+    """
+    A ranked copy of the scoreboard, shared by every request until the
+    refresher replaces it.  The rows are rendered to HTML once, when the
+    snapshot is built.
+    """
+
+    def __init__(self, rows, build_time):
+        self.rows = rows
+        self.build_time = build_time
+        self.built_at = time.time()
+        # when the rows last changed, for Last-Modified
+        self.changed_at = self.built_at
+        self.etag = hashlib.sha1(repr(rows).encode()).hexdigest()
+        self.rows_html = None
+        # the live stream's event id as of these rows
+        self.version = None
+
+
+def diff_rows(old, new):
+    """
+    The changes from old to new rows for live viewers: each row that is new
+    or changed, with the id of the row it now follows (None at the top), and
+    the ids of the rows that are gone.  Rows that only shifted because others
+    moved around them aren't sent, viewers renumber the ranks themselves.
+    """
+    before = {row["id"]: row for row in old}
+    changed = []
+    after = None
+    for row in new:
+        if before.get(row["id"]) != row:
+            changed.append({**row, "after": after})
+        after = row["id"]
+    current = {row["id"] for row in new}
+    removed = [row["id"] for row in old if row["id"] not in current]
+    return {"rows": changed, "removed": removed}
+
 
-    Args:
-    mac (str): The MAC address to check.
+class Deltas:
+    """
+    The recent changes between snapshots, as server-sent events.  A change
+    is encoded once, and every live viewer's stream waits on the same event
+    and reads it from the same history, so the cost of a change doesn't grow
+    with the number of viewers.
 
-    Returns:
-    bool: True if the MAC address is valid, False otherwise.
+    Event ids are "<boot>-<seq>".  boot changes when the process restarts, so
+    viewers of an older process know to reload rather than patch.
     """
-    # Regular expression for matching a MAC address with dashes
-    pattern = "^([0-9A-Fa-f]{2}-){5}([0-9A-Fa-f]{2})$"
 
-    # Using re.match to check if the MAC address matches the pattern
-    if re.match(pattern, mac):
-        return True
+    def __init__(self, history):
+        self.boot = secrets.token_hex(4)
+        self.seq = 0
+        self.history = collections.deque(maxlen=history)
+        # set and replaced by every publish
+        self.changed = asyncio.Event()
+
+    def version(self):
+        return f"{self.boot}-{self.seq}"
+
+    def publish(self, change):
+        self.seq += 1
+        self.history.append((self.seq, json.dumps(change, separators=(",", ":"))))
+        self.changed.set()
+        self.changed = asyncio.Event()
+        return self.version()
+
+    def parse_version(self, version):
+        """the seq in version, None if it isn't one of this process's"""
+        boot, _, seq = version.partition("-")
+        if boot != self.boot or not seq.isdigit() or int(seq) > self.seq:
+            return None
+        return int(seq)
+
+    def missed(self, seq):
+        """events after seq, None if some have already left the history"""
+        events = [(s, data) for s, data in self.history if s > seq]
+        if seq < self.seq and (not events or events[0][0] != seq + 1):
+            return None
+        return events
+
+    async def stream(self, version):
+        """the live event stream for a viewer that has seen up to version"""
+        seq = self.parse_version(version)
+        # starts the response straight away rather than at the first event
+        yield ": connected\n\n"
+        while seq is not None:
+            if self.seq == seq:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), keepalive_period)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+            events = self.missed(seq)
+            if events is None:
+                break
+            for seq, data in events:
+                yield f"id: {self.boot}-{seq}\nevent: delta\ndata: {data}\n\n"
+        yield "event: reload\ndata: {}\n\n"
+
+
+snapshot = None
+snapshot_ready = asyncio.Event()
+deltas = Deltas(delta_history)
+
+
+def render_rows(rows, version):
+    live = f"{app.url_path_for('live')}?since={version}"
+    return Markup(templates.get_template("rows.html").render(data=rows, live=live))
+
+
+async def build_snapshot():
+    global snapshot
+    start = time.perf_counter()
+    new = Snapshot(await get_redis_data(), time.perf_counter() - start)
+    if snapshot is not None and snapshot.etag == new.etag:
+        # an unchanged board keeps its validators and rendered rows
+        new.changed_at = snapshot.changed_at
+        new.rows_html = snapshot.rows_html
+        new.version = snapshot.version
     else:
-        return False
+        if snapshot is None:
+            new.version = deltas.version()
+        else:
+            new.version = deltas.publish(diff_rows(snapshot.rows, new.rows))
+        # a big board takes a while to render, in the meantime pages are still
+        # served from the old snapshot and their streams catch up
+        new.rows_html = await asyncio.to_thread(render_rows, new.rows, new.version)
+    snapshot = new
+    snapshot_ready.set()
 
 
-async def get_redis_data():
+async def watch_leaderboard(changed):
+    """
+    Sets changed whenever the api server publishes a change, and after every
+    (re)subscribe so changes made while disconnected aren't missed.
+    """
+    while True:
+        try:
+            pubsub = client.pubsub()
+            await pubsub.subscribe(LEADERBOARD_CHANNEL)
+            changed.set()
+            while True:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=30
+                )
+                if message:
+                    changed.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.warning("leaderboard watcher: %s, reconnecting", err)
+            await asyncio.sleep(1)
+
+
+async def refresh_snapshots():
+    """
+    Rebuilds the snapshot when a change is published, at most once every
+    min_refresh_period so a burst of changes costs one rebuild, and at least
+    once every max_refresh_period.
+    """
+    changed = asyncio.Event()
+    watcher = asyncio.create_task(watch_leaderboard(changed))
     try:
-        r = await coredis.Redis(host="127.0.0.1", port=6379)
-        result = []
-        keys = await r.keys("*")
-        for key in keys:
-            print(key)
-            # if the key matches a mac address
-            if is_valid_uuid(key.decode()):
-                data = await r.json.get(key)
-                if data["intro"]["complete"]:
-                    try:
-                        matches = len(data["challenge1"]["matches"])
-                    except:
-                        matches = 0
-                    # compute the rank
-                    score = 0
-                    if data["challenge1"]["complete"]:
-                        score += 1000
-                    if data["challenge2"]["complete"]:
-                        score += 2000
-                    if data["challenge3"]["complete"]:
-                        score += 3000
-                    score += matches
-                    d = {
-                        "handle": data["badgeHandle"],
-                        "score": score,
-                        "challenge1": data["challenge1"]["complete"],
-                        "challenge2": data["challenge2"]["complete"],
-                        "challenge3": data["challenge3"]["complete"],
-                        "matches": matches,
-                    }
-                    print(d)
-                    result.append(d)
-        sorted_list = sorted(result, key=lambda x: x["score"], reverse=True)
-    except:
-        sorted_list = []
-
-    return sorted_list
+        while True:
+            changed.clear()
+            try:
+                await build_snapshot()
+            except coredis.exceptions.RedisError as err:
+                # keep serving the last good snapshot
+                logger.error("rebuilding the scoreboard failed: %s", err)
+            await asyncio.sleep(min_refresh_period)
+            try:
+                await asyncio.wait_for(
+                    changed.wait(), max(0, max_refresh_period - min_refresh_period)
+                )
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        watcher.cancel()
 
 
 def random_motd():
@@ -80,12 +315,68 @@ def random_motd():
     return random.choice(messages)
 
 
-@app.route("/")
-async def index():
-    data_dict = await get_redis_data()
-    motd = random_motd()
-    return render_template("scoreboard.html", data=data_dict, motd=motd)
+def not_modified(request, current):
+    """
+    Whether the viewer's copy, going by If-None-Match or else
+    If-Modified-Since, still has the current rows
+    """
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or f'"{current.etag}"' in tags
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return since >= int(current.changed_at)
+    return False
+
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    try:
+        await asyncio.wait_for(snapshot_ready.wait(), 10)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Scoreboard not ready")
+    current = snapshot
+
+    # browsers revalidate every time, and get a 304 until the rows change
+    headers = {
+        "Cache-Control": "no-cache",
+        "ETag": f'W/"{current.etag}"',
+        "Last-Modified": formatdate(current.changed_at, usegmt=True),
+    }
+    if not_modified(request, current):
+        return Response(status_code=304, headers=headers)
+
+    page = templates.get_template("scoreboard.html").render(
+        rows=current.rows_html,
+        motd=random_motd(),
+        age=round(time.time() - current.built_at),
+        build_ms=round(current.build_time * 1000),
+    )
+    return HTMLResponse(page, headers=headers)
+
+
+@app.get("/live")
+async def live(request: Request, since: str = ""):
+    """
+    Server-sent events that patch the scoreboard in place, see
+    static/live.js.  Viewers give the snapshot version their page was
+    rendered from, or the id of the last event on a reconnect.
+    """
+    version = request.headers.get("Last-Event-ID") or since
+    return StreamingResponse(
+        deltas.stream(version),
+        media_type="text/event-stream",
+        # proxies mustn't hold the events back
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port=8080)
+    # a single process, since the snapshot and the live streams' history are
+    # kept in memory
+    uvicorn.run("app:app", port=8080, host="0.0.0.0", proxy_headers=True)
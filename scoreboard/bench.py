@@ -0,0 +1,118 @@
+"""
+Measures how many page views a running scoreboard serves a second, for
+comparing servers and settings.
+
+    python bench.py --url http://127.0.0.1:8080 --concurrency 50 --duration 20
+
+--conditional revalidates with the ETag of the first response, like a
+browser reloading a page it already has, and --live holds that many /live
+streams open during the run to see what connected viewers cost.  Pages are
+served from memory, so the redis behind the scoreboard barely matters, but
+the size of the board does.
+"""
+
+import argparse
+import asyncio
+import re
+import time
+from collections import defaultdict
+
+import httpx
+
+
+def percentile(values, p):
+    """p-th percentile of already sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def viewer(http, headers, end_at, latencies, statuses):
+    while time.monotonic() < end_at:
+        start = time.perf_counter()
+        try:
+            r = await http.get("/", headers=headers)
+            status = r.status_code
+        except httpx.HTTPError as err:
+            status = type(err).__name__
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[status] += 1
+
+
+async def live_viewer(http, url, opened):
+    async with http.stream("GET", url) as r:
+        r.raise_for_status()
+        opened.append(r.status_code)
+        async for _ in r.aiter_bytes():
+            pass
+
+
+async def bench(args):
+    limits = httpx.Limits(max_connections=args.concurrency + args.live + 1)
+    async with httpx.AsyncClient(
+        base_url=args.url, limits=limits, timeout=args.timeout
+    ) as http:
+        first = await http.get("/")
+        first.raise_for_status()
+        print(f"page is {len(first.content)} bytes")
+        headers = None
+        if args.conditional:
+            headers = {"If-None-Match": first.headers["ETag"]}
+
+        # the stream as of the page, so it stays open
+        live_url = re.search(r'data-live="([^"]+)"', first.text).group(1)
+        opened = []
+        streams = []
+        for _ in range(args.live):
+            streams.append(asyncio.create_task(live_viewer(http, live_url, opened)))
+            # a burst of connections overflows the server's listen backlog
+            await asyncio.sleep(0.002)
+        while len(opened) < args.live:
+            failed = [s for s in streams if s.done()]
+            if failed:
+                await failed[0]
+                raise RuntimeError("a live stream closed")
+            await asyncio.sleep(0.1)
+        if streams:
+            print(f"{len(opened)} live streams open")
+
+        latencies = []
+        statuses = defaultdict(int)
+        start = time.monotonic()
+        end_at = start + args.duration
+        await asyncio.gather(
+            *(
+                viewer(http, headers, end_at, latencies, statuses)
+                for _ in range(args.concurrency)
+            )
+        )
+        elapsed = time.monotonic() - start
+        for stream in streams:
+            stream.cancel()
+
+    latencies.sort()
+    print(
+        f"{len(latencies)} requests in {elapsed:.1f}s, "
+        f"{len(latencies) / elapsed:.1f} req/s, "
+        f"p50 {percentile(latencies, 50):.1f}ms "
+        f"p95 {percentile(latencies, 95):.1f}ms "
+        f"p99 {percentile(latencies, 99):.1f}ms"
+    )
+    print(", ".join(f"{k}: {v}" for k, v in sorted(statuses.items(), key=str)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a running scoreboard")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument(
+        "--conditional",
+        action="store_true",
+        help="send If-None-Match, so unchanged pages are a 304",
+    )
+    parser.add_argument(
+        "--live", type=int, default=0, help="/live streams to hold open"
+    )
+    parser.add_argument("--timeout", type=float, default=30)
+    asyncio.run(bench(parser.parse_args()))
@@ -0,0 +1,88 @@
+// Keeps the scoreboard up to date without reloading: each "delta" event from
+// /live carries the rows that are new or changed, with the id of the row
+// each now follows, and the ids of the rows that are gone.  Rows that only
+// shifted around them are left where they are and renumbered.
+(() => {
+    const board = document.getElementById("rows");
+    if (!board || !window.EventSource) {
+        return;
+    }
+    const icons = [
+        ["challenge1", board.dataset.mic, "MiC", "mic"],
+        ["challenge2", board.dataset.kans, "Kans", "kans"],
+        ["challenge3", board.dataset.shade, "Shade", "shade"],
+    ];
+
+    function rowElement(id) {
+        return board.querySelector(`.row[data-id="${id}"]`);
+    }
+
+    function render(record) {
+        let el = rowElement(record.id);
+        if (!el) {
+            el = document.createElement("div");
+            el.className = "row";
+            el.dataset.id = record.id;
+            for (let i = 0; i < 6; i++) {
+                const cell = document.createElement("div");
+                cell.className = `value${i}`;
+                el.appendChild(cell);
+            }
+        }
+        const cells = el.children;
+        cells[0].setAttribute("score", record.score);
+        cells[1].textContent = record.handle;
+        icons.forEach(([challenge, src, alt, cls], i) => {
+            const cell = cells[i + 2];
+            if (!record[challenge]) {
+                cell.replaceChildren();
+            } else if (!cell.firstElementChild) {
+                const img = document.createElement("img");
+                img.src = src;
+                img.alt = alt;
+                img.className = cls;
+                cell.replaceChildren(img);
+            }
+        });
+        cells[5].textContent = record.matches;
+        el.classList.remove("changed");
+        // restarts the highlight animation
+        void el.offsetWidth;
+        el.classList.add("changed");
+        return el;
+    }
+
+    function apply(delta) {
+        for (const id of delta.removed) {
+            rowElement(id)?.remove();
+        }
+        // in rank order, so each row's predecessor is already in place
+        for (const record of delta.rows) {
+            const el = render(record);
+            const previous = record.after && rowElement(record.after);
+            if (previous) {
+                previous.after(el);
+            } else {
+                board.prepend(el);
+            }
+        }
+        Array.from(board.children).forEach((el, i) => {
+            const rank = ` ${i + 1} `;
+            if (el.firstElementChild.textContent !== rank) {
+                el.firstElementChild.textContent = rank;
+            }
+        });
+        const age = document.getElementById("age");
+        if (age) {
+            age.dataset.builtAt = Date.now();
+        }
+    }
+
+    const source = new EventSource(board.dataset.live);
+    source.addEventListener("delta", (event) => apply(JSON.parse(event.data)));
+    // too far behind, or the server restarted
+    source.addEventListener("reload", () => {
+        source.close();
+        location.reload();
+    });
+})();